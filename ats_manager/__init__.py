@@ -1,4 +1,8 @@
 import os, shutil
+import copy
+import time
+import threading
+import concurrent.futures
 import git
 import logging
 
@@ -9,11 +13,19 @@ import ats_manager.bootstrap as bootstrap
 import ats_manager.test_runner as test_runner
 import ats_manager.clean as ats_clean
 import ats_manager.utils as utils
+import ats_manager.proc as proc
+import ats_manager.governor as governor
+import ats_manager.fingerprint as fingerprint
+import ats_manager.cache as cache
+import ats_manager.timing as timing
+import ats_manager.registry as registry
+import ats_manager.quota as quota
+import ats_manager.orphans as orphans
 
 from ats_manager.ui import *
 
 
-def install_ats(args):
+def install_ats(args, setup_repo=True):
     """Create a new ATS installation.
 
     Creates a modulefile, clones the repos, bootstraps the code, and
@@ -21,6 +33,9 @@ def install_ats(args):
 
     To see arguments, run: `python bin/install_ats.py -h`
 
+    If setup_repo is False, the repository is assumed to already be
+    cloned and on the right branches (see install_matrix).
+
     Returns
     -------
     int : return code: 
@@ -43,47 +58,65 @@ def install_ats(args):
     logging.info('ATS new branch: {}'.format(args.new_ats_branch))
     logging.info('Amanzi new branch: {}'.format(args.new_amanzi_branch))
     build_name = names.name('ats', args.build_name, args.machine, args.compiler_id, args.build_type)
+    start = _register_start(build_name, args)
+    _evict_before([build_name,], args)
 
     # repository setup
-    logging.info('-----------------------------------------------------------------------------')
-    repo.get_repo(args.repo_kind,
-                  args.repo,
-                  skip_clone=args.skip_clone,
-                  clobber=args.clobber,
-                  amanzi_branch=args.amanzi_branch,
-                  ats_branch=args.ats_branch,
-                  new_amanzi_branch=args.new_amanzi_branch,
-                  new_ats_branch=args.new_ats_branch)
+    if setup_repo:
+        logging.info('-----------------------------------------------------------------------------')
+        with timing.stage(build_name, 'clone'):
+            _setup_repo(args)
 
     # TPL setup
     logging.info('-----------------------------------------------------------------------------')
     args.enable_structured = False
-    rc, tpls_name = _check_or_install_tpls(args)
-    if rc != 0: return rc, tpls_name
+    with timing.stage(build_name, 'tpls'):
+        rc, tpls_name = _check_or_install_tpls(args)
+    if rc != 0:
+        registry.update(build_name, status='failed', tpls_name=tpls_name)
+        return rc, tpls_name
 
     # modulefile setup
     logging.info('-----------------------------------------------------------------------------')
     logging.info('Generating module file:')    
     logging.info('  Fully resolved name: {}'.format(build_name))
-    template_params = modulefile.create_modulefile(build_name, args.repo, tpls_name,
-                                                   build_type=args.build_type)
+    with timing.stage(build_name, 'modulefile'):
+        template_params = modulefile.create_modulefile(build_name, args.repo, tpls_name,
+                                                       build_type=args.build_type)
                                  
     # bootstrap
     logging.info('-----------------------------------------------------------------------------')
     logging.info('Calling bootstrap:')
     # bootstrap, make, install
-    rc = bootstrap.bootstrap_ats(build_name, args)
-    if rc != 0: return rc, build_name
+    with timing.stage(build_name, 'bootstrap'):
+        rc, restored = _bootstrap_or_restore(bootstrap.bootstrap_ats, build_name, tpls_name, args)
+    if rc != 0:
+        _register_finish(build_name, args, tpls_name, 'failed', start)
+        return rc, build_name
 
     # amanzi make tests
-    if args.amanzi_tests:
+    if args.amanzi_tests and restored:
+        logging.warning('Not running Amanzi tests: the install was restored from the '
+                        'artifact cache, so there is no build dir to run them in.')
+    elif args.amanzi_tests:
         logging.info('Running tests:')
-        rc = test_runner.amanziUnitTests(build_name)
-
+        with timing.stage(build_name, 'amanzi tests'):
+            rc = test_runner.amanziUnitTests(build_name, use_cache=(not args.no_test_cache),
+                                             telemetry_interval=args.telemetry)
+
+    # ats regression tests
+    if not args.skip_ats_tests:
+        logging.info('-----------------------------------------------------------------------------')
+        with timing.stage(build_name, 'ats tests'):
+            rc = max(rc, test_runner.atsRegressionTests(build_name, jobs=args.jobs,
+                                                         use_cache=(not args.no_test_cache),
+                                                         telemetry_interval=args.telemetry))
+
+    _register_finish(build_name, args, tpls_name, 'installed', start, test_rc=rc)
     return rc, build_name
 
 
-def install_amanzi(args):
+def install_amanzi(args, setup_repo=True):
     """Create a new Amanzi installation.
 
     Creates a modulefile, clones the repos, bootstraps the code, and
@@ -91,6 +124,9 @@ def install_amanzi(args):
 
     To see arguments, run: `python bin/install_amanzi.py -h`
 
+    If setup_repo is False, the repository is assumed to already be
+    cloned and on the right branches (see install_matrix).
+
     Returns
     -------
     int : return code: 
@@ -112,47 +148,175 @@ def install_amanzi(args):
     logging.info('Amanzi new branch: {}'.format(args.new_amanzi_branch))
     build_name = names.name('amanzi', args.build_name, args.machine,
                             args.compiler_id, args.build_type)
+    start = _register_start(build_name, args)
+    _evict_before([build_name,], args)
 
     # repository setup
-    logging.info('-----------------------------------------------------------------------------')
-    repo.get_repo(args.repo_kind,
-                  args.repo,
-                  skip_clone=args.skip_clone,
-                  clobber=args.clobber,
-                  amanzi_branch=args.amanzi_branch,
-                  ats_branch=None,
-                  new_amanzi_branch=args.new_amanzi_branch,
-                  new_ats_branch=None)
+    if setup_repo:
+        logging.info('-----------------------------------------------------------------------------')
+        with timing.stage(build_name, 'clone'):
+            _setup_repo(args)
 
     # TPL setup
     logging.info('-----------------------------------------------------------------------------')
-    rc, tpls_name = _check_or_install_tpls(args)
-    if rc != 0: return rc, tpls_name
+    with timing.stage(build_name, 'tpls'):
+        rc, tpls_name = _check_or_install_tpls(args)
+    if rc != 0:
+        registry.update(build_name, status='failed', tpls_name=tpls_name)
+        return rc, tpls_name
 
     # modulefile setup
     logging.info('-----------------------------------------------------------------------------')
     logging.info('Generating module file:')    
     logging.info('  Fully resolved name: {}'.format(build_name))
-    template_params = modulefile.create_modulefile(build_name, args.repo, tpls_name,
-                                                   build_type=args.build_type)
+    with timing.stage(build_name, 'modulefile'):
+        template_params = modulefile.create_modulefile(build_name, args.repo, tpls_name,
+                                                       build_type=args.build_type)
 
     # bootstrap
     logging.info('-----------------------------------------------------------------------------')
     logging.info('Calling bootstrap:')
     # bootstrap, make, install
-    rc = bootstrap.bootstrap_amanzi(build_name, args)
-    if rc != 0: return rc, build_name
+    with timing.stage(build_name, 'bootstrap'):
+        rc, restored = _bootstrap_or_restore(bootstrap.bootstrap_amanzi, build_name, tpls_name, args)
+    if rc != 0:
+        _register_finish(build_name, args, tpls_name, 'failed', start)
+        return rc, build_name
 
     # amanzi make tests
-    if args.amanzi_tests:
+    if args.amanzi_tests and restored:
+        logging.warning('Not running Amanzi tests: the install was restored from the '
+                        'artifact cache, so there is no build dir to run them in.')
+    elif args.amanzi_tests:
         logging.info('Running tests:')
-        rc = test_runner.amanziUnitTests(build_name)
+        with timing.stage(build_name, 'amanzi tests'):
+            rc = test_runner.amanziUnitTests(build_name, use_cache=(not args.no_test_cache),
+                                             telemetry_interval=args.telemetry)
 
+    _register_finish(build_name, args, tpls_name, 'installed', start, test_rc=rc)
     return rc, build_name
 
 
-def install_tpls(args):
-    """Check for and create a new TPLs installation."""
+def update_ats(module_name, recompile=True, run_amanzi_tests=True,
+               run_ats_tests=True, jobs=None, use_test_cache=True, fail_fast=False,
+               telemetry_interval=None):
+    """Pulls and incrementally rebuilds an existing ATS installation.
+
+    See _update for details.
+
+    Returns
+    -------
+    int : return code:
+        0 = success
+       -1 = failed build
+       >0 = successful build but failing tests
+    str : name of the modulefile
+    """
+    assert(module_name.split('/')[0] == 'ats')
+    return _update(module_name, recompile, run_amanzi_tests, run_ats_tests, jobs,
+                   use_test_cache, fail_fast, telemetry_interval)
+
+
+def update_amanzi(module_name, recompile=True, run_amanzi_tests=True, jobs=None,
+                  use_test_cache=True, fail_fast=False, telemetry_interval=None):
+    """Pulls and incrementally rebuilds an existing Amanzi installation.
+
+    See _update for details.
+    """
+    assert(module_name.split('/')[0] == 'amanzi')
+    return _update(module_name, recompile, run_amanzi_tests, False, jobs,
+                   use_test_cache, fail_fast, telemetry_interval)
+
+
+def _update(module_name, recompile, run_amanzi_tests, run_ats_tests, jobs,
+            use_test_cache, fail_fast, telemetry_interval):
+    """Pulls the repo of an existing installation and rebuilds it.
+
+    If the bootstrap script, as filled now from the arguments of the
+    last bootstrap, changed since the build was last bootstrapped (or
+    bootstrap.sh itself changed), the build is re-bootstrapped with the
+    new script.  Otherwise this is just an incremental make
+    install in AMANZI_BUILD_DIR, which re-runs CMake only if CMake
+    inputs changed.  A change in the TPL version cannot be handled
+    here and requires a new install.
+    """
+    logging.info('Updating: {}'.format(module_name))
+    logging.info('=============================================================================')
+    start = time.time()
+    env = modulefile.read_modulefile(module_name)
+    src_dir = env['AMANZI_SRC_DIR']
+    build_dir = env['AMANZI_BUILD_DIR']
+
+    # repository update
+    logging.info('-----------------------------------------------------------------------------')
+    with timing.stage(module_name, 'pull'):
+        # checked before pulling, so the source is left matching the build
+        if os.path.join('config', 'SuperBuild', 'TPLVersions.cmake') in repo.incoming_changes(src_dir):
+            logging.error('TPL versions changed, a new install is required.  Not pulling.')
+            return -1, module_name
+        amanzi_repo, changed = repo.pull_amanzi_ats(src_dir)
+
+    rc = 0
+    if recompile:
+        logging.info('-----------------------------------------------------------------------------')
+        memory_limit = None
+        if proc.is_supported():
+            memory_limit = governor.default_memory_limit()
+        if jobs is None:
+            jobs = bootstrap.default_jobs(memory_limit)
+
+        cmake_changed = [f for f in changed if os.path.basename(f) == 'CMakeLists.txt'
+                         or f.endswith('.cmake')]
+        expected = bootstrap.expected_bootstrap(module_name)
+        if not os.path.isfile(os.path.join(build_dir, 'CMakeCache.txt')):
+            reason = 'no existing build'
+        elif 'bootstrap.sh' in changed:
+            reason = 'bootstrap.sh changed'
+        elif bootstrap.bootstrap_changed(module_name, expected):
+            reason = 'bootstrap script changed'
+        else:
+            reason = None
+
+        if reason is not None:
+            logging.info('Calling bootstrap ({}):'.format(reason))
+            with timing.stage(module_name, 'bootstrap'):
+                rc = bootstrap.rebootstrap(module_name, memory_limit, fail_fast,
+                                           telemetry_interval, script=expected)
+        else:
+            if len(cmake_changed) > 0:
+                logging.info('CMake inputs changed, reconfiguring: {}'.format(', '.join(cmake_changed)))
+            logging.info('Calling make install:')
+            with timing.stage(module_name, 'make install'):
+                rc = bootstrap.make_install(module_name, jobs, memory_limit, fail_fast,
+                                            telemetry_interval)
+        if rc != 0:
+            _register_update(module_name, src_dir, 'failed', start)
+            return rc, module_name
+
+    # amanzi make tests
+    if run_amanzi_tests:
+        logging.info('Running tests:')
+        with timing.stage(module_name, 'amanzi tests'):
+            rc = test_runner.amanziUnitTests(module_name, use_cache=use_test_cache,
+                                             telemetry_interval=telemetry_interval)
+
+    if run_ats_tests:
+        logging.info('-----------------------------------------------------------------------------')
+        with timing.stage(module_name, 'ats tests'):
+            rc = max(rc, test_runner.atsRegressionTests(module_name, jobs=jobs,
+                                                         use_cache=use_test_cache,
+                                                         telemetry_interval=telemetry_interval))
+
+    _register_update(module_name, src_dir, 'installed', start, test_rc=rc)
+    return rc, module_name
+
+
+def install_tpls(args, tpls_name=None):
+    """Check for and create a new TPLs installation.
+
+    On success, the TPLs' configuration fingerprint is recorded so that
+    identical configurations can reuse them.
+    """
     logging.info('Installing TPLs:')
     logging.info('=============================================================================')
     logging.info('TPLs version: {}'.format(args.tpls_version))
@@ -161,26 +325,286 @@ def install_tpls(args):
     assert(args.tpls_build_type is not None)
     if args.trilinos_build_type is None:
         args.trilinos_build_type = args.tpls_build_type
-    
-    tpls_name = names.name('amanzi-tpls', args.tpls_version,
-                           args.machine, args.compiler_id, args.trilinos_build_type)
+
+    if tpls_name is None:
+        tpls_name = names.name('amanzi-tpls', args.tpls_version,
+                               args.machine, args.compiler_id, args.trilinos_build_type)
+    fp_items = fingerprint.tpls_items(args, args.tpls_version)
+    start = _register_start(tpls_name, args, version=args.tpls_version,
+                            build_type=args.trilinos_build_type)
+    _evict_before([tpls_name,], args)
 
     # make the modulefile
     logging.info('-----------------------------------------------------------------------------')
     logging.info('Generating module file:')    
     logging.info(f'  Fully resolved name: {tpls_name}')
-    modulefile.create_tpls_modulefile(tpls_name, args.repo_kind, args.repo,
-                                      tpls_build_type=args.tpls_build_type,
-                                      trilinos_build_type=args.trilinos_build_type,
-                                      modulefiles=args.modulefiles)
+    with timing.stage(tpls_name, 'modulefile'):
+        modulefile.create_tpls_modulefile(tpls_name, args.repo_kind, args.repo,
+                                          tpls_build_type=args.tpls_build_type,
+                                          trilinos_build_type=args.trilinos_build_type,
+                                          modulefiles=args.modulefiles)
 
     # bootstrap
     logging.info('-----------------------------------------------------------------------------')
     logging.info('Calling bootstrap:')
-    rc = bootstrap.bootstrap_tpls(tpls_name, args)
+    tpls_fp = fingerprint.compute(fp_items)
+    if args.artifact_cache and not args.force_tpls and \
+       cache.restore(tpls_name, cache.cache_key(tpls_name, tpls_fp)):
+        rc = 0
+    else:
+        with timing.stage(tpls_name, 'bootstrap'):
+            rc = bootstrap.bootstrap_tpls(tpls_name, args)
+        if rc == 0 and args.artifact_cache:
+            cache.store(tpls_name, cache.cache_key(tpls_name, tpls_fp))
+    if rc == 0:
+        fingerprint.record(tpls_name, tpls_fp, fp_items)
+    registry.update(tpls_name, status=('installed' if rc == 0 else 'failed'),
+                    fingerprint=tpls_fp, tpls_version=args.tpls_version,
+                    build_seconds=time.time() - start, last_used=time.time(),
+                    **registry.commits(args.repo_kind, args.repo), **registry.sizes(tpls_name))
     return rc, tpls_name
 
 
+def _register_start(name, args, **fields):
+    """Registers a build as in progress, returning the start time."""
+    if 'version' not in fields:
+        fields['version'] = args.build_name
+    if 'build_type' not in fields:
+        fields['build_type'] = args.build_type
+    registry.update(name, status='building', repo=args.repo, machine=args.machine,
+                    compiler_id=args.compiler_id, install_dir=names.install_dir(name),
+                    build_dir=names.build_dir(name), **fields)
+    return time.time()
+
+
+def _register_finish(build_name, args, tpls_name, status, start, test_rc=None):
+    """Registers the outcome of an Amanzi or ATS install."""
+    fields = registry.commits(args.repo_kind, args.repo)
+    fields.update(registry.sizes(build_name))
+    try:
+        fp_items = fingerprint.build_items(args, tpls_name)
+        if fp_items is not None:
+            fields['fingerprint'] = fingerprint.compute(fp_items)
+    except Exception as err:
+        logging.warning(f'  cannot fingerprint {build_name}: {err}')
+    registry.update(build_name, status=status, test_rc=test_rc, tpls_name=tpls_name,
+                    tpls_version=args.tpls_version, build_seconds=time.time() - start,
+                    last_used=time.time(), **fields)
+    registry.touch(tpls_name)
+
+
+def _register_update(module_name, src_dir, status, start, test_rc=None):
+    """Registers the outcome of an update."""
+    kind = module_name.split('/')[0]
+    repo = os.path.basename(src_dir)
+    registry.update(module_name, status=status, test_rc=test_rc, repo=repo,
+                    build_seconds=time.time() - start, last_used=time.time(),
+                    **registry.commits(kind, repo), **registry.sizes(module_name))
+
+
+def _evict_before(build_names, args):
+    """Evicts build trees to make room for new builds of build_names, if
+    asked and not already done for them (see install_matrix)."""
+    if not (args.evict or quota.auto_evict()) or getattr(args, 'evicted', False):
+        return
+    budget = quota.budget()
+    if budget is None:
+        logging.warning('Not evicting: no ATS_DISK_BUDGET is set')
+        return
+    logging.info('-----------------------------------------------------------------------------')
+    logging.info('Evicting least recently used build trees')
+    # sizes are kept current by install, update, and clean, so are not
+    # measured again here
+    rows = quota.builds(refresh=False)
+    needed = 0
+    for name in build_names:
+        estimate = quota.estimate(name, rows)
+        logging.info(f'  expecting {name} to need {quota.format_size(estimate)}')
+        needed += estimate
+    # wait, as the space is only freed once the trash is reaped
+    evict(max(0, budget - needed), force=True, wait=True, keep=build_names, rows=rows)
+
+
+def _bootstrap_or_restore(bootstrap_func, build_name, tpls_name, args):
+    """Restores the install from the artifact cache, if requested and
+    available, or else bootstraps it (caching the result).
+
+    Returns the return code and whether the install was restored, in
+    which case there is no build dir.
+    """
+    key = None
+    if args.artifact_cache:
+        fp_items = fingerprint.build_items(args, tpls_name)
+        if fp_items is not None:
+            key = cache.cache_key(build_name, fingerprint.compute(fp_items))
+            if cache.restore(build_name, key):
+                # there is nothing to bootstrap, but a later update
+                # needs the script to build from source
+                bootstrap.write_bootstrap(build_name, args)
+                return 0, True
+
+    rc = bootstrap_func(build_name, args)
+    if rc == 0 and key is not None:
+        cache.store(build_name, key)
+    return rc, False
+
+
+def _setup_repo(args):
+    """Clones or checks the repo described by args."""
+    if args.repo_kind == 'ats':
+        ats_branch = args.ats_branch
+        new_ats_branch = args.new_ats_branch
+    else:
+        ats_branch = None
+        new_ats_branch = None
+
+    return repo.get_repo(args.repo_kind,
+                         args.repo,
+                         skip_clone=args.skip_clone,
+                         clobber=args.clobber,
+                         amanzi_branch=args.amanzi_branch,
+                         ats_branch=ats_branch,
+                         new_amanzi_branch=args.new_amanzi_branch,
+                         new_ats_branch=new_ats_branch,
+                         use_mirror=args.git_mirror,
+                         clone_jobs=args.clone_jobs,
+                         depth=args.clone_depth,
+                         clone_filter=args.clone_filter,
+                         update=args.update_repo)
+
+
+def _parse_variant(variant, args):
+    """Parses a BUILD_TYPE[:COMPILER_ID[:MACHINE]] string.
+
+    Missing or empty fields default to the values in args.
+    """
+    fields = variant.split(':')
+    if len(fields) > 3:
+        raise ValueError(f'Invalid build variant "{variant}", expected BUILD_TYPE[:COMPILER_ID[:MACHINE]]')
+    fields = fields + [''] * (3 - len(fields))
+
+    build_type = fields[0] if fields[0] else args.build_type
+    if build_type not in names.valid_build_types:
+        raise ValueError(f'Invalid build type "{build_type}" in build variant "{variant}"')
+    compiler_id = fields[1] if fields[1] else args.compiler_id
+    machine = fields[2] if fields[2] else args.machine
+    return build_type, compiler_id, machine
+
+
+def install_matrix(args):
+    """Install several variants of the same repository concurrently.
+
+    The repository is cloned (or checked) once, then each variant in
+    args.variant (BUILD_TYPE[:COMPILER_ID[:MACHINE]]) is run through
+    the TPLs, modulefile, and bootstrap stages in its own thread.
+    All variants use the same toolchain, so must differ in BUILD_TYPE.
+    Variants that resolve to the same TPLs share a single TPL build.
+    The core budget, args.core_budget, and the memory limit of the
+    memory governor are split evenly across the variants.
+
+    Returns
+    -------
+    int : return code:
+        0 = success
+       -1 = at least one failed build
+       >0 = successful builds but failing tests
+    list : names of the generated modulefiles
+    """
+    if args.repo is None:
+        args.repo = args.build_name
+
+    if args.repo_kind == 'ats':
+        install = install_ats
+    else:
+        install = install_amanzi
+
+    variants = [_parse_variant(v, args) for v in args.variant]
+    variants = list(dict.fromkeys(variants)) # remove duplicates, keeping order
+
+    # all variants are built with the same compilers, MPI, and modulefiles,
+    # and COMPILER_ID and MACHINE only name the build
+    build_types = [build_type for build_type, compiler_id, machine in variants]
+    for build_type in dict.fromkeys(build_types):
+        if build_types.count(build_type) > 1:
+            same = ', '.join(':'.join(f or '' for f in v).rstrip(':') for v in variants
+                             if v[0] == build_type)
+            raise ValueError(f'Build variants {same} differ only in COMPILER_ID or MACHINE, '
+                             'which only label the build, so would be identical builds')
+
+    core_budget = args.core_budget
+    if core_budget is None:
+        core_budget = utils.available_cores()
+    jobs = max(1, core_budget // len(variants))
+
+    # memory is split the same way as cores
+    memory_limit = bootstrap.get_memory_limit(args)
+    if memory_limit is not None:
+        memory_limit = memory_limit / len(variants)
+        if args.mem_per_job > 0:
+            jobs = max(1, min(jobs, int(memory_limit / (args.mem_per_job * 2**30))))
+
+    logging.info('Installing build matrix:')
+    logging.info('=============================================================================')
+    logging.info(f'Repo version: {args.repo_kind}/{args.repo}')
+    logging.info(f'Core budget: {core_budget} ({jobs} per variant)')
+    for build_type, compiler_id, machine in variants:
+        logging.info(f'  variant: build_type={build_type}, compiler_id={compiler_id}, machine={machine}')
+
+    # eviction, once for all variants, so none evicts the build tree of
+    # another before it is registered as building
+    _evict_before([names.name(args.repo_kind, args.build_name, machine, compiler_id, build_type)
+                   for build_type, compiler_id, machine in variants], args)
+
+    # repository setup, shared by all variants
+    logging.info('-----------------------------------------------------------------------------')
+    _setup_repo(args)
+
+    variant_args = []
+    for build_type, compiler_id, machine in variants:
+        vargs = copy.copy(args)
+        vargs.build_type = build_type
+        vargs.compiler_id = compiler_id
+        vargs.machine = machine
+        vargs.jobs = jobs
+        vargs.evicted = True
+        if memory_limit is not None:
+            vargs.memory_limit = memory_limit / 2**30
+        variant_args.append(vargs)
+
+    rcs = []
+    build_names = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(variant_args)) as executor:
+        futures = [executor.submit(install, vargs, setup_repo=False) for vargs in variant_args]
+        for vargs, future in zip(variant_args, futures):
+            try:
+                rc, build_name = future.result()
+            except Exception as err:
+                logging.error(f'Variant {vargs.build_type}:{vargs.compiler_id}:{vargs.machine} raised: {err}')
+                rc, build_name = -1, None
+            rcs.append(rc)
+            build_names.append(build_name)
+
+    logging.info('Build matrix results:')
+    for build_name, rc in zip(build_names, rcs):
+        logging.info(f'  {build_name} : {rc}')
+
+    if any(rc < 0 for rc in rcs):
+        return -1, build_names
+    return max(rcs), build_names
+
+
+# TPL builds are deduplicated across threads: each TPL name has a
+# lock, and TPLs that were force-rebuilt in this process are not
+# rebuilt again.
+_tpls_locks_lock = threading.Lock()
+_tpls_locks = dict()
+_tpls_built = set()
+
+def _tpls_lock(tpls_name):
+    with _tpls_locks_lock:
+        return _tpls_locks.setdefault(tpls_name, threading.Lock())
+
+
 def _check_or_install_tpls(args):
     tpls_version = names.tpls_version(args.repo_kind, args.repo)
     if args.tpls_build_type is None:
@@ -192,21 +616,64 @@ def _check_or_install_tpls(args):
     if args.trilinos_build_type is None:
         args.trilinos_build_type = args.tpls_build_type
             
+    args.tpls_version = tpls_version
+    tpls_fp = fingerprint.compute(fingerprint.tpls_items(args, tpls_version))
+    tpls_name = _resolve_tpls_name(args, tpls_version, tpls_fp)
+    tpls_config_file = _tpls_config_file(tpls_name)
+
+    with _tpls_lock(tpls_name):
+        logging.info(f'Checking for TPLs at: {tpls_config_file}')
+        if os.path.isfile(tpls_config_file) and \
+           (not args.force_tpls or tpls_name in _tpls_built):
+            logging.info('  FOUND... using existing TPLs')
+            registry.touch(tpls_name)
+            return 0, tpls_name
+        else:
+            rc, tpls_name = install_tpls(args, tpls_name)
+            if rc == 0:
+                _tpls_built.add(tpls_name)
+            return rc, tpls_name
+
+
+def _tpls_config_file(tpls_name):
+    return os.path.join(names.install_dir(tpls_name), 'share', 'cmake', 'amanzi-tpl-config.cmake')
+
+
+def _resolve_tpls_name(args, tpls_version, tpls_fp):
+    """Finds the name of the TPLs install for this fingerprint.
+
+    This is, in order, an existing install with the same fingerprint,
+    the usual name if it is free or matches, or else the usual name
+    with the fingerprint appended to the version.
+    """
+    logging.info(f'TPLs fingerprint: {tpls_fp}')
+    tpls_name = fingerprint.lookup(tpls_fp)
+    if tpls_name is not None:
+        logging.info(f'  matches existing TPLs: {tpls_name}')
+        return tpls_name
+
     tpls_name = names.name('amanzi-tpls', tpls_version,
                            args.machine, args.compiler_id, args.trilinos_build_type)
-    tpls_install_dir = names.install_dir(tpls_name)
-    tpls_config_file = os.path.join(tpls_install_dir, 'share', 'cmake', 'amanzi-tpl-config.cmake')
-    logging.info(f'Checking for TPLs at: {tpls_config_file}')
-
-    if os.path.isfile(tpls_config_file) and not args.force_tpls:
-        logging.info('  FOUND... using existing TPLs')
-        return 0, tpls_name
+    if not os.path.isfile(_tpls_config_file(tpls_name)):
+        return tpls_name
+
+    existing_fp = fingerprint.read(tpls_name)
+    if existing_fp == tpls_fp:
+        return tpls_name
+    elif existing_fp is None and args.force_tpls:
+        # rebuilding TPLs from before fingerprinting, take over the name
+        return tpls_name
+
+    if existing_fp is None:
+        logging.info(f'  TPLs at {tpls_name} have no recorded fingerprint, not reusing them.  '
+                     'Use --force-tpls to rebuild them in place.')
     else:
-        args.tpls_version = tpls_version
-        return install_tpls(args)
+        logging.info(f'  TPLs at {tpls_name} were built with a different configuration.')
+    return names.name('amanzi-tpls', f'{tpls_version}-{tpls_fp[:8]}',
+                      args.machine, args.compiler_id, args.trilinos_build_type)
     
 
-def clean(module_name, remove=False, source=False, force=False):
+def clean(module_name, remove=False, source=False, force=False, wait=False):
     """Cleans or completely removes a build.
 
     By defualt, this removes: 
@@ -218,6 +685,8 @@ def clean(module_name, remove=False, source=False, force=False):
      * all bootstrap scripts
      * any test directories
 
+    Directories are moved to the trash and deleted in the background;
+    if wait, this blocks until they are gone.
     """
     amanzi_install_dir = names.install_dir(module_name)
     ats_clean.remove_dir(amanzi_install_dir, force)
@@ -233,7 +702,123 @@ def clean(module_name, remove=False, source=False, force=False):
         modulefile = names.modulefile_path(module_name)
         ats_clean.remove_file(modulefile, force)
 
+    # only builds already registered, so a mistyped name is not added
+    if registry.get(module_name) is not None and \
+       not os.path.exists(amanzi_install_dir) and not os.path.exists(amanzi_build_dir):
+        if remove and not os.path.exists(names.modulefile_path(module_name)):
+            status = 'removed'
+        else:
+            status = 'cleaned'
+        registry.update(module_name, status=status, install_size=0, build_size=0)
+
+    if wait:
+        ats_clean.wait_for_reapers()
     return 0, module_name
+
+
+def evict(budget=None, installs=False, keep=(), dry_run=False, force=False, wait=False,
+          refresh=True, rows=None):
+    """Removes least recently used builds until disk use is within budget.
+
+    Build trees are removed first.  If installs, whole builds (as in
+    clean with remove) that no remaining install depends on are removed
+    next.  Builds in keep are never removed.
+
+    budget is in bytes, and defaults to ATS_DISK_BUDGET.  Returns 0 if
+    disk use is within budget, 1 if not enough could be evicted.
+    """
+    if budget is None:
+        budget = quota.budget()
+    if budget is None:
+        logging.info('No ATS_DISK_BUDGET is set, nothing to evict')
+        return 0, []
+    if rows is None:
+        rows = quota.builds(refresh)
+    quota.log_usage(rows, budget)
+
+    used = quota.usage(rows)
+    evicted = []
+    for what, name, size in quota.plan(rows, budget, installs, keep):
+        logging.info(f'  evicting {what} of {name}, last used {_last_used(name)} '
+                     f'({quota.format_size(size)})')
+        if dry_run:
+            used -= size
+            continue
+        if what == 'build':
+            if ats_clean.remove_dir(names.build_dir(name), force) == 0:
+                registry.update(name, build_size=0)
+        else:
+            clean(name, remove=True, force=force)
+        if not os.path.exists(names.build_dir(name) if what == 'build' else names.install_dir(name)):
+            used -= size
+            evicted.append(name)
+
+    if wait:
+        ats_clean.wait_for_reapers()
+    if used > budget:
+        logging.warning(f'Disk use of {quota.format_size(used)} is still over the budget of '
+                        f'{quota.format_size(budget)}' + ('' if installs else
+                        ', consider also evicting installs'))
+        return 1, evicted
+    logging.info(f'Disk use {"would be" if dry_run else "is now"} {quota.format_size(used)}')
+    return 0, evicted
+
+
+def _last_used(name):
+    row = registry.get(name)
+    if row is None or row['last_used'] is None:
+        return 'never'
+    return time.strftime('%Y-%m-%d', time.localtime(row['last_used']))
+
+
+def gc(min_age=24, dry_run=False, force=False, wait=False, jobs=8):
+    """Removes orphaned scripts, modulefiles, and build and install trees.
+
+    Orphans are the pieces of builds that have no modulefile or no
+    install, left by failed or aborted installs (see orphans.py).
+    Nothing modified in the last min_age hours is removed.  Orphans
+    are listed and, after a single confirmation unless force, removed
+    in bulk.
+    """
+    logging.info('Scanning for orphans')
+    logging.info('=============================================================================')
+    found, complete = orphans.find(min_age * 3600, jobs)
+    logging.info(f'  {len(complete)} complete builds')
+    if len(found) == 0:
+        logging.info('  no orphans found')
+        return 0, []
+
+    for orphan in found:
+        logging.info(f'  {orphan["what"]:<10} {quota.format_size(orphan["size"]):>9}  '
+                     f'{orphan["path"]} ({orphan["reason"]})')
+    total = sum(orphan['size'] for orphan in found)
+    logging.info(f'  {len(found)} orphans, {quota.format_size(total)} reclaimable')
+    if dry_run:
+        return 0, []
+    if not force and not utils.query_yes_no(f'Remove all {len(found)} orphans?'):
+        return 1, []
+
+    removed = []
+    for orphan in found:
+        if orphan['what'] in ['install', 'build']:
+            res = ats_clean.remove_dir(orphan['path'], True)
+        else:
+            res = ats_clean.remove_file(orphan['path'], True)
+        if res == 0:
+            removed.append(orphan['path'])
+
+    for name in set(orphan['name'] for orphan in found if orphan['name'] is not None):
+        if registry.get(name) is not None:
+            install_exists = os.path.exists(names.install_dir(name))
+            if not install_exists and not os.path.exists(names.modulefile_path(name)):
+                status = 'removed'
+            else:
+                status = 'installed' if install_exists else 'cleaned'
+            registry.update(name, status=status, **registry.sizes(name))
+
+    if wait:
+        ats_clean.wait_for_reapers()
+    return 0, removed
     
     
           
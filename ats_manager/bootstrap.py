@@ -1,9 +1,16 @@
 """Sets up and runs bootstrap"""
 import os,sys,stat,shutil
 import subprocess
+import hashlib
+import json
+import argparse
 import logging
 import ats_manager.names as names
 import ats_manager.utils as utils
+import ats_manager.proc as proc
+import ats_manager.governor as governor
+import ats_manager.timing as timing
+from ats_manager.config import config
 
 
 def _set_arg(args, key, val):
@@ -13,6 +20,126 @@ def _set_arg(args, key, val):
         args[key] = 'disable'
         
 
+def get_parallel(inargs):
+    """Number of build jobs passed to bootstrap.sh.
+
+    Uses --jobs if provided, otherwise the number of available cores.
+    The result is stored back in inargs so that every script generated
+    for this install (TPLs and Amanzi/ATS) uses the same value.
+    """
+    if inargs.jobs is None:
+        inargs.jobs = default_jobs(get_memory_limit(inargs), inargs.mem_per_job)
+    return inargs.jobs
+
+
+def default_jobs(memory_limit=None, mem_per_job=2.0):
+    """Number of available cores, capped so that jobs of mem_per_job GB
+    fit in memory_limit bytes."""
+    jobs = utils.available_cores()
+
+    # don't start more jobs than memory can hold
+    if memory_limit is not None and mem_per_job > 0:
+        mem_jobs = max(1, int(memory_limit / (mem_per_job * 2**30)))
+        if mem_jobs < jobs:
+            logging.info(f'  Limiting build jobs from {jobs} to {mem_jobs} '
+                         f'to fit in {memory_limit / 2**30:.1f} GB')
+            jobs = mem_jobs
+    logging.info(f'  Using {jobs} build jobs')
+    return jobs
+
+
+def get_memory_limit(inargs):
+    """Memory limit, in bytes, for the build's process tree.
+
+    Uses --memory-limit if provided, otherwise 90% of the memory
+    available when first called.  Returns None if the memory governor
+    is disabled or unsupported on this platform.
+    """
+    if inargs.disable_memory_governor or not proc.is_supported():
+        return None
+    if inargs.memory_limit is None:
+        inargs.memory_limit = governor.default_memory_limit() / 2**30
+    return int(inargs.memory_limit * 2**30)
+
+
+def _stamp_file(module_name):
+    return os.path.join(names.build_dir(module_name), '.ats_manager_bootstrap')
+
+
+# install arguments that go into bootstrap scripts
+_bootstrap_inputs = ['build_static', 'enable_structured', 'enable_geochemistry',
+                     'mpi_wrapper_kind', 'mpi_dir', 'compiler_cache', 'compiler_cache_size',
+                     'bootstrap_options', 'jobs', 'generator']
+
+
+def _hash(script):
+    return hashlib.sha256(script.encode('utf-8')).hexdigest()
+
+
+def _read_script(prefix, module_name):
+    with open(utils.script_path(prefix, module_name), 'r') as fid:
+        return fid.read()
+
+
+def write_bootstrap_stamp(module_name, script, inputs):
+    """Records, in the build dir, the bootstrap script that was last
+    successfully run and the install arguments it was filled from
+    (None if not known)."""
+    with open(_stamp_file(module_name), 'w') as fid:
+        json.dump(dict(script=_hash(script), inputs=inputs), fid)
+
+
+def _read_bootstrap_stamp(module_name):
+    """The bootstrap stamp, or None if there is none."""
+    try:
+        with open(_stamp_file(module_name), 'r') as fid:
+            contents = fid.read().strip()
+    except FileNotFoundError:
+        return None
+    try:
+        return json.loads(contents)
+    except ValueError:
+        # stamps of older versions held only the script hash
+        return dict(script=contents, inputs=None)
+
+
+def expected_bootstrap(module_name):
+    """The bootstrap script that the build would be given now.
+
+    It is filled by the current ats_manager, in the current
+    environment, from the install arguments the build was last
+    bootstrapped with.  Returns None if those are not known, or if
+    the compilers cannot be found in this environment.
+    """
+    stamp = _read_bootstrap_stamp(module_name)
+    if stamp is None or stamp['inputs'] is None:
+        return None
+    inputs = argparse.Namespace(**stamp['inputs'])
+    if None in which_compilers(inputs.mpi_wrapper_kind):
+        logging.warning('  compilers not found in this environment, not checking bootstrap arguments')
+        return None
+    return _fillers[module_name.split('/')[0]](module_name, inputs)
+
+
+def bootstrap_changed(module_name, expected=None):
+    """Has the bootstrap script changed since the build was last
+    bootstrapped?
+
+    expected is the script the build would be given now (see
+    expected_bootstrap), compared if known, otherwise the existing
+    script is.  A build without a stamp, e.g. from before stamps were
+    written, is assumed unchanged and its existing script is stamped.
+    """
+    stamp = _read_bootstrap_stamp(module_name)
+    if stamp is None:
+        logging.info('  no record of the last bootstrap, assuming the bootstrap script is unchanged')
+        write_bootstrap_stamp(module_name, _read_script('bootstrap', module_name), None)
+        return False
+    if expected is None:
+        expected = _read_script('bootstrap', module_name)
+    return stamp['script'] != _hash(expected)
+
+
 _compiler_tmp = "--with-c-compiler={} --with-cxx-compiler={} --with-fort-compiler={}"
 def get_compilers(compiler_names, mpi_dir):
     compilers = _compiler_tmp.format(*compiler_names)
@@ -57,6 +184,202 @@ def which_compilers(family=None, cc=None, cxx=None, ftn=None):
     return _which(cc1, cxx1, ftn1)
 
 
+#
+# compiler caching
+#
+# Compilers are wrapped in small scripts that call ccache or sccache
+# with a shared cache in ATS_BUILD_BASE/compiler-cache.  The cache
+# settings live in the wrapper, so they apply equally to bootstrap and
+# to later incremental builds.  CCACHE_BASEDIR makes paths relative, so
+# different clones and build dirs of the same sources share hits.
+#
+def compiler_cache_dir(tool):
+    return os.path.join(config['ATS_BUILD_BASE'], 'compiler-cache', tool)
+
+
+def _compiler_cache_env(tool, size):
+    if tool == 'ccache':
+        basedir = os.path.commonpath([config['ATS_BASE'], config['ATS_BUILD_BASE']])
+        if basedir == os.path.sep:
+            basedir = config['ATS_BASE']
+        return dict(CCACHE_DIR=compiler_cache_dir(tool),
+                    CCACHE_MAXSIZE=size,
+                    CCACHE_BASEDIR=basedir,
+                    CCACHE_NOHASHDIR='true')
+    elif tool == 'sccache':
+        return dict(SCCACHE_DIR=compiler_cache_dir(tool),
+                    SCCACHE_CACHE_SIZE=size)
+    else:
+        raise ValueError(f'Unknown compiler cache {tool}')
+
+
+_compiler_wrapper_template = \
+"""#!/bin/sh
+{env}
+exec {tool} {compiler} "$@"
+"""
+def wrap_compilers(compilers, tool, size='20G'):
+    """Returns wrappers for compilers that call them through tool."""
+    tool_path = shutil.which(tool)
+    if tool_path is None:
+        raise RuntimeError(f'Compiler cache "{tool}" not found in PATH')
+
+    env = _compiler_cache_env(tool, size)
+    os.makedirs(env[tool.upper()+'_DIR'], exist_ok=True)
+    wrapper_id = hashlib.sha256(json.dumps([tool_path, env, compilers]).encode('utf-8')).hexdigest()[0:12]
+    wrapper_dir = os.path.join(config['ATS_BUILD_BASE'], 'compiler-cache', 'wrappers', wrapper_id)
+    os.makedirs(wrapper_dir, exist_ok=True)
+
+    wrappers = []
+    for compiler in compilers:
+        if compiler is None:
+            wrappers.append(None)
+            continue
+        wrapper = os.path.join(wrapper_dir, os.path.basename(compiler))
+        # concurrent builds may be running this wrapper
+        utils.write_executable(wrapper, _compiler_wrapper_template.format(
+            env='\n'.join(f'export {k}="{v}"' for k, v in env.items()),
+            tool=tool_path, compiler=compiler))
+        wrappers.append(wrapper)
+    logging.info(f'  Using {tool} compiler wrappers in {wrapper_dir}')
+    return wrappers
+
+
+def resolve_compilers(inargs):
+    """Bootstrap compiler arguments, wrapped by the compiler cache if requested."""
+    compilers = which_compilers(inargs.mpi_wrapper_kind)
+    if inargs.compiler_cache is not None:
+        compilers = wrap_compilers(compilers, inargs.compiler_cache, inargs.compiler_cache_size)
+    return get_compilers(compilers, inargs.mpi_dir)
+
+
+def compiler_cache_stats(tool):
+    """Dictionary of hit/miss counts of the compiler cache, or None."""
+    env = dict(os.environ)
+    env.update(_compiler_cache_env(tool, ''))
+    try:
+        if tool == 'ccache':
+            out = subprocess.run(['ccache', '--print-stats'], env=env, capture_output=True,
+                                 text=True, check=True).stdout
+            stats = dict(line.split('\t') for line in out.splitlines() if '\t' in line)
+            hits = int(stats.get('direct_cache_hit', 0)) + int(stats.get('preprocessed_cache_hit', 0))
+            misses = int(stats.get('cache_miss', 0))
+        else:
+            out = subprocess.run(['sccache', '--show-stats', '--stats-format=json'], env=env,
+                                 capture_output=True, text=True, check=True).stdout
+            stats = json.loads(out)['stats']
+            hits = sum(stats['cache_hits']['counts'].values())
+            misses = sum(stats['cache_misses']['counts'].values())
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError) as err:
+        logging.debug(f'Could not read {tool} statistics: {err}')
+        return None
+    return dict(hits=hits, misses=misses)
+
+
+def _log_compiler_cache_stats(tool, before):
+    after = compiler_cache_stats(tool)
+    if before is None or after is None:
+        return
+    hits = after['hits'] - before['hits']
+    misses = after['misses'] - before['misses']
+    total = hits + misses
+    rate = 100. * hits / total if total > 0 else 0.
+    logging.info(f'  {tool}: {hits} hits, {misses} misses ({rate:.1f}% hit rate)')
+
+
+#
+# generators
+#
+# bootstrap.sh configures with CMake's default generator and calls make
+# itself.  To build with Ninja, the bootstrap script exports
+# CMAKE_GENERATOR (read by CMake >= 3.15) and puts a make shim first in
+# PATH.  The shim runs ninja in directories generated for Ninja, and the
+# real make everywhere else (e.g. autotools TPLs in the superbuild).
+#
+_make_shim_template = \
+"""#!/usr/bin/env bash
+# make shim written by ats_manager: runs ninja in Ninja build dirs
+make_args=("$@")
+dir=.
+args=()
+chdir() {{
+    case "$1" in
+        /*) dir="$1" ;;
+        *) dir="${{dir}}/$1" ;;
+    esac
+}}
+while [ $# -gt 0 ]; do
+    case "$1" in
+        # options passed on to ninja; -j or -l without a number means no
+        # limit to make, so is dropped, leaving ninja's default
+        -j|-l) case "$2" in [0-9]*) args+=("$1" "$2"); shift ;; esac ;;
+        -j*|-l*|-k|-n) args+=("$1") ;;
+        --jobs=*) args+=("-j${{1#--jobs=}}") ;;
+        --keep-going) args+=("-k") ;;
+        --dry-run|--just-print) args+=("-n") ;;
+        # directories, which (as in make) accumulate
+        -C|--directory) chdir "$2"; shift ;;
+        -C*) chdir "${{1#-C}}" ;;
+        --directory=*) chdir "${{1#--directory=}}" ;;
+        # other options taking an argument, ignored along with it
+        -f|-I|-o|-W|--file|--makefile|--include-dir|--old-file|--assume-old|--new-file|--assume-new|--what-if) shift ;;
+        # other options and variable assignments, ignored
+        -*|*=*) ;;
+        *) args+=("$1") ;;
+    esac
+    shift
+done
+
+if [ -f "${{dir}}/build.ninja" -a ! -f "${{dir}}/Makefile" ]; then
+    exec {ninja} -C "${{dir}}" "${{args[@]}}"
+fi
+
+PATH="${{PATH#{shim_dir}:}}"
+exec {make} "${{make_args[@]}}"
+"""
+def _generator_env(generator):
+    """Lines added to bootstrap scripts to select the CMake generator."""
+    if generator == 'make':
+        return ''
+    elif generator != 'ninja':
+        raise ValueError(f'Unknown generator {generator}')
+
+    ninja = shutil.which('ninja')
+    make = shutil.which('make')
+    if ninja is None:
+        raise RuntimeError('Generator "ninja" requested but ninja not found in PATH')
+    if make is None:
+        raise RuntimeError('make not found in PATH')
+
+    shim_dir = os.path.join(config['ATS_BUILD_BASE'], 'generator-shims', 'bin')
+    os.makedirs(shim_dir, exist_ok=True)
+    # concurrent builds may be running the shim
+    utils.write_executable(os.path.join(shim_dir, 'make'),
+                           _make_shim_template.format(ninja=ninja, make=make, shim_dir=shim_dir))
+    return f'export CMAKE_GENERATOR=Ninja\nexport PATH={shim_dir}:${{PATH}}\n'
+
+
+def _run_bootstrap(module_name, cmd, inargs):
+    """Writes and runs a bootstrap script, then fixes permissions."""
+    if inargs.compiler_cache is not None:
+        stats = compiler_cache_stats(inargs.compiler_cache)
+    timer = timing.OutputTimer(module_name)
+    rc = utils.run_cmd('bootstrap', module_name, cmd,
+                       memory_limit=get_memory_limit(inargs),
+                       fail_fast=inargs.fail_fast, on_lines=timer.feed,
+                       telemetry_interval=inargs.telemetry)
+    timer.save()
+    if inargs.compiler_cache is not None:
+        _log_compiler_cache_stats(inargs.compiler_cache, stats)
+
+    if rc == 0:
+        write_bootstrap_stamp(module_name, cmd,
+                              dict((k, getattr(inargs, k)) for k in _bootstrap_inputs))
+    utils.chmod(names.build_dir(module_name), incremental=True)
+    utils.chmod(names.install_dir(module_name), incremental=True)
+    return rc
+
+
 _bootstrap_tpls_template = \
 """#!/usr/bin/env bash
 
@@ -78,12 +401,12 @@ echo "AMANZI_TPLS_SOURCE_DIR = ${{AMANZI_TPLS_SOURCE_DIR}}"
 echo "AMANZI_TPLS_BUILD_DIR = ${{AMANZI_TPLS_BUILD_DIR}}"
 echo "AMANZI_TPLS_DIR = ${{AMANZI_TPLS_DIR}}"
 echo "-----------------------------------------------------"
-
+{generator}
 ./bootstrap.sh \
     --disable-build_amanzi \
     --${{AMANZI_TRILINOS_BUILD_TYPE}}_trilinos \
     --${{AMANZI_TPLS_BUILD_TYPE}}_tpls \
-    --parallel=8 \
+    --parallel={parallel} \
     {shared_libs} \
     {compilers} \
     --tpl-build-dir=${{AMANZI_TPLS_BUILD_DIR}} \
@@ -103,7 +426,7 @@ echo "-----------------------------------------------------"
 
 exit $?
 """ 
-def bootstrap_tpls(tpls_name, inargs):
+def fill_bootstrap_tpls(tpls_name, inargs):
     args = dict()
     args['module_name'] = tpls_name
     args['python_interp'] = sys.executable
@@ -116,17 +439,20 @@ def bootstrap_tpls(tpls_name, inargs):
     _set_arg(args, 'structured', inargs.enable_structured)
     _set_arg(args, 'geochemistry', inargs.enable_geochemistry)
 
-    args['compilers'] = get_compilers(which_compilers(inargs.mpi_wrapper_kind), inargs.mpi_dir)
+    args['compilers'] = resolve_compilers(inargs)
     args['flags'] = inargs.bootstrap_options
+    args['parallel'] = get_parallel(inargs)
+    args['generator'] = _generator_env(inargs.generator)
 
     logging.info('  Filling bootstrap')
     logging.debug(args)
     cmd = _bootstrap_tpls_template.format(**args)
     logging.debug(cmd)
-    rc = utils.run_cmd('bootstrap', tpls_name, cmd)
-    utils.chmod(names.build_dir(tpls_name))
-    utils.chmod(names.install_dir(tpls_name))
-    return rc
+    return cmd
+
+
+def bootstrap_tpls(tpls_name, inargs):
+    return _run_bootstrap(tpls_name, fill_bootstrap_tpls(tpls_name, inargs), inargs)
 
 
 _bootstrap_amanzi_template = \
@@ -152,11 +478,11 @@ echo ""
 echo "AMANZI_TPLS_BUILD_DIR = ${{AMANZI_TPLS_BUILD_DIR}}"
 echo "AMANZI_TPLS_DIR = ${{AMANZI_TPLS_DIR}}"
 echo "-----------------------------------------------------"
-
+{generator}
 ./bootstrap.sh \
     --${{AMANZI_BUILD_TYPE}} \
     {shared_libs} \
-    --parallel=8 \
+    --parallel={parallel} \
     --amanzi-build-dir=${{AMANZI_BUILD_DIR}} \
     --amanzi-install-prefix=${{AMANZI_DIR}} \
     --{structured}-structured \
@@ -177,7 +503,7 @@ echo "-----------------------------------------------------"
 
 exit $?
 """ 
-def bootstrap_amanzi(module_name, inargs):
+def fill_bootstrap_amanzi(module_name, inargs):
     args = dict()
     args['module_name'] = module_name
     args['python_interp'] = sys.executable
@@ -190,17 +516,20 @@ def bootstrap_amanzi(module_name, inargs):
     _set_arg(args, 'structured', inargs.enable_structured)
     _set_arg(args, 'geochemistry', inargs.enable_geochemistry)
 
-    args['compilers'] = get_compilers(which_compilers(inargs.mpi_wrapper_kind), inargs.mpi_dir)
+    args['compilers'] = resolve_compilers(inargs)
     args['flags'] = inargs.bootstrap_options
+    args['parallel'] = get_parallel(inargs)
+    args['generator'] = _generator_env(inargs.generator)
 
     logging.info('Filling bootstrap')
     logging.info(args)
     cmd = _bootstrap_amanzi_template.format(**args)
     logging.info(cmd)
-    rc = utils.run_cmd('bootstrap', module_name, cmd)
-    utils.chmod(names.build_dir(module_name))
-    utils.chmod(names.install_dir(module_name))
-    return rc
+    return cmd
+
+
+def bootstrap_amanzi(module_name, inargs):
+    return _run_bootstrap(module_name, fill_bootstrap_amanzi(module_name, inargs), inargs)
         
 
 _bootstrap_ats_template = \
@@ -226,11 +555,11 @@ echo ""
 echo "AMANZI_TPLS_BUILD_DIR = ${{AMANZI_TPLS_BUILD_DIR}}"
 echo "AMANZI_TPLS_DIR = ${{AMANZI_TPLS_DIR}}"
 echo "-----------------------------------------------------"
-
+{generator}
 ./bootstrap.sh \
     --${{AMANZI_BUILD_TYPE}} \
     {shared_libs} \
-    --parallel=8 \
+    --parallel={parallel} \
     --amanzi-build-dir=${{AMANZI_BUILD_DIR}} \
     --amanzi-install-prefix=${{AMANZI_DIR}} \
     --disable-structured \
@@ -253,7 +582,7 @@ echo "-----------------------------------------------------"
 
 exit $?
 """ 
-def bootstrap_ats(module_name, inargs):
+def fill_bootstrap_ats(module_name, inargs):
     args = dict()
     args['module_name'] = module_name
     args['python_interp'] = sys.executable
@@ -264,19 +593,106 @@ def bootstrap_ats(module_name, inargs):
         args['shared_libs'] = '--enable-shared'
         
     _set_arg(args, 'geochemistry', inargs.enable_geochemistry)
-    args['compilers'] = get_compilers(which_compilers(inargs.mpi_wrapper_kind), inargs.mpi_dir)
+    args['compilers'] = resolve_compilers(inargs)
     args['flags'] = inargs.bootstrap_options
+    args['parallel'] = get_parallel(inargs)
+    args['generator'] = _generator_env(inargs.generator)
 
         
     logging.info('Filling bootstrap command:')
     logging.info(args)
     cmd = _bootstrap_ats_template.format(**args)
     logging.info(cmd)
-    rc = utils.run_cmd('bootstrap', module_name, cmd)
-    utils.chmod(names.build_dir(module_name))
-    utils.chmod(names.install_dir(module_name))
-    return rc
+    return cmd
+
+
+def bootstrap_ats(module_name, inargs):
+    return _run_bootstrap(module_name, fill_bootstrap_ats(module_name, inargs), inargs)
+
+
+_fillers = {'amanzi-tpls' : fill_bootstrap_tpls,
+            'amanzi' : fill_bootstrap_amanzi,
+            'ats' : fill_bootstrap_ats}
+
+
+def write_bootstrap(module_name, inargs):
+    """Writes, without running, the bootstrap script of a build, e.g.
+    one restored from the artifact cache, so it can be rebootstrapped."""
+    utils.write_script('bootstrap', module_name,
+                       _fillers[module_name.split('/')[0]](module_name, inargs))
         
 
 
 
+
+
+
+_make_install_template = \
+"""#!/usr/bin/env bash
+
+if [ ! -z "${{MODULESHOME}}" ]; then
+    source ${{MODULESHOME}}/init/profile
+fi
+
+if [ ! -z "${{ATS_BASE}}" ]; then
+    module use -a ${{ATS_BASE}}/modulefiles
+fi
+module load {module_name}
+
+cd ${{AMANZI_BUILD_DIR}}
+
+echo "Incremental build of: {module_name}"
+echo "-----------------------------------------------------"
+echo "AMANZI_BUILD_DIR= ${{AMANZI_BUILD_DIR}}"
+echo "AMANZI_DIR = ${{AMANZI_DIR}}"
+echo "-----------------------------------------------------"
+
+cmake --build ${{AMANZI_BUILD_DIR}} --target install --parallel {parallel}
+
+exit $?
+"""
+def make_install(module_name, jobs, memory_limit=None, fail_fast=False,
+                 telemetry_interval=None):
+    """Incrementally rebuilds and installs an already-bootstrapped build.
+
+    CMake re-runs itself as needed if any CMake inputs changed.  This
+    uses cmake --build, so works with whichever generator the build
+    was configured with.
+    """
+    cmd = _make_install_template.format(module_name=module_name, parallel=jobs)
+    logging.info(cmd)
+    timer = timing.OutputTimer(module_name)
+    rc = utils.run_cmd('make_install', module_name, cmd, memory_limit=memory_limit,
+                       fail_fast=fail_fast, on_lines=timer.feed,
+                       telemetry_interval=telemetry_interval)
+    timer.save()
+    utils.chmod(names.install_dir(module_name), incremental=True)
+    return rc
+
+
+def rebootstrap(module_name, memory_limit=None, fail_fast=False, telemetry_interval=None,
+                script=None):
+    """Re-runs the bootstrap script of a build.
+
+    If script is provided (see expected_bootstrap), it replaces the
+    existing script, otherwise the existing script is re-run.
+    """
+    stamp = _read_bootstrap_stamp(module_name)
+    inputs = None if stamp is None else stamp['inputs']
+    if script is None:
+        try:
+            script = _read_script('bootstrap', module_name)
+        except FileNotFoundError:
+            logging.error(f'No bootstrap script for {module_name}, so it cannot be rebuilt.  '
+                          'Reinstall it instead.')
+            return -1
+    timer = timing.OutputTimer(module_name)
+    rc = utils.run_cmd('bootstrap', module_name, script, memory_limit=memory_limit,
+                       fail_fast=fail_fast, on_lines=timer.feed,
+                       telemetry_interval=telemetry_interval)
+    timer.save()
+    if rc == 0:
+        write_bootstrap_stamp(module_name, script, inputs)
+    utils.chmod(names.build_dir(module_name), incremental=True)
+    utils.chmod(names.install_dir(module_name), incremental=True)
+    return rc
@@ -0,0 +1,154 @@
+"""Cache of packed installations.
+
+After a successful build, the install directory is packed into a
+compressed tarball in ATS_CACHE_DIR, named by the configuration
+fingerprint of the build (see fingerprint.py).  A later install with
+the same fingerprint unpacks the tarball instead of building.
+
+Installs are not relocatable, so the cache key includes the install
+directory and an archive is always restored to the directory it was
+packed from.
+
+Packing and unpacking stream tar through a separate compression
+process, using zstd (or pigz) with multiple threads when available.
+
+If ATS_CACHE_URL is set, new archives are also pushed to, and missing
+archives pulled from, a shared remote cache (see remote.py).
+"""
+import os
+import json
+import hashlib
+import time
+import shutil
+import tempfile
+import subprocess
+import logging
+
+import ats_manager.names as names
+import ats_manager.remote as remote
+from ats_manager.config import config
+
+
+def cache_dir():
+    return config['ATS_CACHE_DIR']
+
+
+def _compressor():
+    """Returns (extension, compress command)."""
+    if shutil.which('zstd') is not None:
+        return '.tar.zst', ['zstd', '-T0', '-3', '-q', '-c']
+    elif shutil.which('pigz') is not None:
+        return '.tar.gz', ['pigz', '-c']
+    else:
+        return '.tar.gz', ['gzip', '-c']
+
+
+def _decompressor(archive):
+    if archive.endswith('.tar.zst'):
+        return ['zstd', '-d', '-q', '-c']
+    elif shutil.which('pigz') is not None:
+        return ['pigz', '-d', '-c']
+    else:
+        return ['gzip', '-d', '-c']
+
+
+def cache_key(name, fingerprint):
+    """Cache key of an install: its fingerprint and where it lives."""
+    return hashlib.sha256(f'{fingerprint}:{names.install_dir(name)}'.encode('utf-8')).hexdigest()
+
+
+def archive_path(key):
+    """Path of the archive for key, or None if it is not cached."""
+    for ext in ['.tar.zst', '.tar.gz']:
+        archive = os.path.join(cache_dir(), key+ext)
+        if os.path.isfile(archive):
+            return archive
+    return None
+
+
+def _pipeline(first, second, stdin=None, stdout=None):
+    """Runs first | second, returning True if both succeed."""
+    p1 = subprocess.Popen(first, stdin=stdin, stdout=subprocess.PIPE)
+    p2 = subprocess.Popen(second, stdin=p1.stdout, stdout=stdout)
+    p1.stdout.close() # so p1 gets SIGPIPE if p2 exits
+    rc2 = p2.wait()
+    rc1 = p1.wait()
+    return rc1 == 0 and rc2 == 0
+
+
+def store(name, key):
+    """Packs the install dir of name into the cache under key."""
+    install_dir = names.install_dir(name)
+    if not os.path.isdir(install_dir):
+        logging.warning(f'Not caching {name}: no install at {install_dir}')
+        return False
+
+    os.makedirs(cache_dir(), exist_ok=True)
+    ext, compress = _compressor()
+    archive = os.path.join(cache_dir(), key+ext)
+    logging.info(f'Packing {install_dir}')
+    logging.info(f'     to: {archive}')
+
+    start = time.time()
+    fd, tmp_archive = tempfile.mkstemp(prefix='.'+key, suffix=ext, dir=cache_dir())
+    try:
+        with os.fdopen(fd, 'wb') as fid:
+            ok = _pipeline(['tar', '-C', os.path.dirname(install_dir), '-cf', '-',
+                            os.path.basename(install_dir)],
+                           compress, stdout=fid)
+        if not ok:
+            logging.warning(f'  packing {name} failed, not caching')
+            return False
+        os.chmod(tmp_archive, 0o644)
+        os.replace(tmp_archive, archive)
+    finally:
+        if os.path.exists(tmp_archive):
+            os.remove(tmp_archive)
+
+    metadata = dict(name=name, key=key, install_dir=install_dir,
+                    created=time.time(), size=os.path.getsize(archive))
+    with open(os.path.join(cache_dir(), key+'.json'), 'w') as fid:
+        json.dump(metadata, fid, indent=2)
+    logging.info(f'  packed {metadata["size"] / 2**30:.2f} GB in {time.time() - start:.0f} s')
+    remote.push(archive)
+    return True
+
+
+def restore(name, key):
+    """Unpacks the cached archive for key into the install dir of name.
+
+    Returns True if the install was restored.  The archive is unpacked
+    next to the install dir and moved into place only once complete,
+    so a failed restore never leaves a partial install behind.
+    """
+    install_dir = names.install_dir(name)
+    if os.path.exists(install_dir):
+        logging.info(f'  not restoring {name}: {install_dir} already exists')
+        return False
+
+    archive = archive_path(key)
+    if archive is None:
+        archive = remote.pull(key, cache_dir())
+    if archive is None:
+        logging.info(f'  no cached install for {key}')
+        return False
+
+    logging.info(f'Restoring {install_dir}')
+    logging.info(f'   from: {archive}')
+    start = time.time()
+    parent = os.path.dirname(install_dir)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.restore-', dir=parent)
+    try:
+        with open(archive, 'rb') as fid:
+            ok = _pipeline(_decompressor(archive), ['tar', '-C', tmp_dir, '-xf', '-'], stdin=fid)
+        unpacked = os.path.join(tmp_dir, os.path.basename(install_dir))
+        if not ok or not os.path.isdir(unpacked):
+            logging.warning(f'  unpacking {archive} failed')
+            return False
+        os.rename(unpacked, install_dir)
+    finally:
+        shutil.rmtree(tmp_dir, True)
+
+    logging.info(f'  restored in {time.time() - start:.0f} s')
+    return True
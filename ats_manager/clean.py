@@ -1,6 +1,11 @@
 """Helper functions for cleaning builds."""
 
-import os, shutil
+import os, sys, shutil
+import errno
+import fcntl
+import tempfile
+import subprocess
+import concurrent.futures
 import ats_manager.utils
 import ats_manager.config
 import logging
@@ -43,12 +48,120 @@ def remove_file(filename, force=False):
         os.remove(filename)
     return res
 
+def _trash_dir(dirname):
+    """Trash area for dirname: .trash in ATS_BUILD_BASE or ATS_BASE,
+    whichever holds it, as it must be on the same filesystem."""
+    ats_bbase = ats_manager.config.config['ATS_BUILD_BASE']
+    if dirname.startswith(ats_bbase):
+        return os.path.join(ats_bbase, '.trash')
+    return os.path.join(ats_manager.config.config['ATS_BASE'], '.trash')
+
+
+def trash_dirs():
+    return sorted(set(os.path.join(ats_manager.config.config[base], '.trash')
+                      for base in ['ATS_BASE', 'ATS_BUILD_BASE']))
+
+
+# the trash dir is passed as an argument, never formatted into the code
+_reaper_cmd = \
+"""import sys
+import logging
+from ats_manager.clean import reap
+trash = sys.argv[1]
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(message)s')
+logging.info(f'reaping {trash}')
+reap(trash)
+logging.info(f'done reaping {trash}')
+"""
+def _spawn_reaper(trash):
+    """Starts a reaper for trash, detached so that it outlives us."""
+    log = os.path.join(ats_manager.config.config['ATS_BASE'], 'logs', 'reaper.log')
+    os.makedirs(os.path.dirname(log), exist_ok=True)
+    env = dict(os.environ)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([package_parent,] +
+                                        [p for p in [env.get('PYTHONPATH', ''),] if p != ''])
+    with open(log, 'a') as fid:
+        subprocess.Popen([sys.executable, '-c', _reaper_cmd, trash],
+                         stdin=subprocess.DEVNULL, stdout=fid, stderr=subprocess.STDOUT,
+                         env=env, start_new_session=True)
+
+
 def remove_dir(dirname, force=False):
-    """Safely removes a directory"""
+    """Safely removes a directory.
+
+    The directory is renamed into a trash area on the same filesystem,
+    so it is gone from dirname at once, and a background reaper deletes
+    it.  Use wait_for_reapers() to block until it is deleted.
+    """
     res = _check(dirname, force)
     if res == 0:
         logging.info('Removing: {}'.format(dirname))
-        shutil.rmtree(dirname, True)
-    return 0
-    
-        
+        trash = _trash_dir(dirname)
+        try:
+            os.makedirs(trash, exist_ok=True)
+            target = tempfile.mkdtemp(prefix=os.path.basename(dirname)+'.', dir=trash)
+            os.rename(dirname, os.path.join(target, os.path.basename(dirname)))
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                logging.info('  cannot move to trash ({}), removing in place'.format(err))
+            shutil.rmtree(dirname, True)
+            return 0
+        _spawn_reaper(trash)
+    return res
+
+
+def _entries(paths):
+    entries = []
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            entries.extend(entry.path for entry in os.scandir(path))
+    return entries
+
+
+def reap(trash, jobs=8):
+    """Deletes everything in a trash area, in parallel.
+
+    Only one reaper works on a trash area at a time; others wait their
+    turn, then delete whatever is left.
+    """
+    if not os.path.isdir(trash):
+        return
+    with open(os.path.join(trash, '.reaper.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        previous = None
+        while True:
+            # trash holds temporary dirs, each holding one removed
+            # directory, whose contents are deleted concurrently, and
+            # then the (now empty) directories above them
+            tops = [entry.path for entry in os.scandir(trash) if entry.name != '.reaper.lock']
+            if len(tops) == 0:
+                break
+            if set(tops) == previous:
+                logging.warning('Cannot delete everything in {}: {}'.format(trash, ', '.join(tops)))
+                break
+            previous = set(tops)
+            removed = _entries(tops)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                list(executor.map(_remove, _entries(removed)))
+            for path in removed + tops:
+                _remove(path)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def wait_for_reapers():
+    """Blocks until all trash areas are empty."""
+    for trash in trash_dirs():
+        if os.path.isdir(trash):
+            logging.info('Waiting on deletion of: {}'.format(trash))
+            reap(trash)
+
@@ -19,6 +19,19 @@ def get_default_config():
 
     # groups and permissions
     rcParams['DEFAULT']['ATS_ADMIN_GROUP'] = ''
+
+    # packed installs, see ats_manager/cache.py
+    rcParams['DEFAULT']['ATS_CACHE_DIR'] = os.path.join('%(ATS_BASE)s', 'cache')
+
+    # shared remote cache, a directory or http(s) URL, see ats_manager/remote.py
+    rcParams['DEFAULT']['ATS_CACHE_URL'] = ''
+
+    # registry of installations, see ats_manager/registry.py
+    rcParams['DEFAULT']['ATS_REGISTRY'] = os.path.join('%(ATS_BASE)s', 'registry.db')
+
+    # total size of build and install dirs, e.g. 2T, see ats_manager/quota.py
+    rcParams['DEFAULT']['ATS_DISK_BUDGET'] = ''
+    rcParams['DEFAULT']['ATS_DISK_AUTO_EVICT'] = 'no'
     return rcParams
 
 
@@ -0,0 +1,77 @@
+"""Detection of fatal errors in build output.
+
+An ErrorScanner is fed the output of a build as it streams, and
+watches for lines that mean the build cannot succeed: CMake errors,
+compiler and linker errors, and failed make or ninja targets.  With
+parallel make, the rest of the build may run on for a long time after
+the first failure, so run_script can kill the build as soon as one is
+seen.
+
+The first match is kept along with the lines around it, which is
+usually the real failure; later errors are most often consequences of
+it.
+"""
+import re
+import collections
+import logging
+
+_patterns = [
+    r'^CMake Error',
+    r'^\S+:\d+(:\d+)?: (fatal )?error:',    # gcc, clang
+    r'^\S+\(\d+\): error( #\d+)?:',         # intel
+    r'\bfatal error:',
+    r'^Error: ',                             # gfortran
+    r'undefined reference to',
+    r'^(/\S+/)?ld(\.\w+)?: cannot find',
+    r'collect2: error: ld returned',
+    r'^make(\[\d+\])?: \*\*\* .*Error \d+(?!\d)(?! \(ignored\))',  # but not '(ignored)', as make continues
+    r'^ninja: build stopped: subcommand failed',
+    r'^FAILED: ',                            # ninja
+]
+
+
+class ErrorScanner:
+    def __init__(self, patterns=None, before=10, after=20):
+        if patterns is None:
+            patterns = _patterns
+        self.regex = re.compile('|'.join(f'(?:{p})' for p in patterns).encode('utf-8'))
+        self.after = after
+        self.num_errors = 0
+        self.first_error = None  # line number of the first error
+        self.first_context = 0   # index of the first error in context
+        self.context = []        # lines around the first error
+        self._recent = collections.deque(maxlen=before)
+        self._num_lines = 0
+
+    def feed(self, lines):
+        """Scans a list of lines (bytes), returning True on the first error."""
+        found = False
+        for line in lines:
+            self._num_lines += 1
+            if self.first_error is not None and len(self.context) < self.first_context + self.after:
+                self.context.append(line)
+
+            if self.regex.search(line) is not None:
+                self.num_errors += 1
+                if self.first_error is None:
+                    self.first_error = self._num_lines
+                    self.context = list(self._recent) + [line,]
+                    self.first_context = len(self.context)
+                    found = True
+            self._recent.append(line)
+        return found
+
+    def summary(self):
+        """Condensed description of the first error, or None."""
+        if self.first_error is None:
+            return None
+        lines = [f'First of {self.num_errors} errors, at output line {self.first_error}:',
+                 '-----------------------------------------------------------------------------']
+        lines.extend(l.decode('utf-8', 'replace') for l in self.context)
+        lines.append('-----------------------------------------------------------------------------')
+        return '\n'.join(lines)
+
+    def log_summary(self):
+        summary = self.summary()
+        if summary is not None:
+            logging.error(summary)
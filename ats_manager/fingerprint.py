@@ -0,0 +1,135 @@
+"""Configuration fingerprints of installations.
+
+A fingerprint is a hash over everything that determines the contents
+of an install: sources, compilers, MPI, and bootstrap flags.  Two
+configurations with the same fingerprint can share one install.
+
+The fingerprint is recorded in the install directory, and TPL installs
+are additionally indexed by fingerprint in
+ATS_BASE/amanzi-tpls/fingerprints.
+"""
+import os, sys
+import json
+import hashlib
+import logging
+import git
+
+import ats_manager.names as names
+import ats_manager.bootstrap as bootstrap
+from ats_manager.config import config
+
+_record_file = 'ats_manager_fingerprint.json'
+
+
+def _hash_file(filename):
+    with open(filename, 'rb') as fid:
+        return hashlib.sha256(fid.read()).hexdigest()
+
+
+def compute(items):
+    """Fingerprint of a dictionary of JSON-able configuration items."""
+    return hashlib.sha256(json.dumps(items, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _compilers(args):
+    compilers = bootstrap.which_compilers(args.mpi_wrapper_kind)
+    mpi_dir = args.mpi_dir
+    if mpi_dir is None:
+        mpi_dir = os.environ.get('MPI_DIR', None)
+    return dict(compilers=[c if c is None else os.path.realpath(c) for c in compilers],
+                compiler_paths=list(compilers),
+                mpi_dir=mpi_dir)
+
+
+def tpls_items(args, tpls_version):
+    """Everything that goes into a TPLs build."""
+    items = dict(kind='amanzi-tpls',
+                 tpls_version=tpls_version,
+                 tpl_versions_cmake=_hash_file(os.path.join(names.tpls_src_dir(args.repo_kind, args.repo),
+                                                            'TPLVersions.cmake')),
+                 tpls_build_type=args.tpls_build_type,
+                 trilinos_build_type=args.trilinos_build_type,
+                 build_static=args.build_static,
+                 enable_structured=args.enable_structured,
+                 enable_geochemistry=args.enable_geochemistry,
+                 bootstrap_options=' '.join(args.bootstrap_options.split()),
+                 modulefiles=list(args.modulefiles),
+                 python=sys.executable,
+                 ats_base=config['ATS_BASE'])
+    items.update(_compilers(args))
+    return items
+
+
+def read(name):
+    """The fingerprint recorded in an install, or None."""
+    try:
+        with open(os.path.join(names.install_dir(name), _record_file), 'r') as fid:
+            return json.load(fid)['fingerprint']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _index_file(fingerprint):
+    return os.path.join(config['ATS_BASE'], 'amanzi-tpls', 'fingerprints', fingerprint)
+
+
+def record(name, fingerprint, items):
+    """Records the fingerprint (and the items that made it) in the install
+    dir, and indexes it."""
+    with open(os.path.join(names.install_dir(name), _record_file), 'w') as fid:
+        json.dump(dict(fingerprint=fingerprint, name=name, items=items), fid, indent=2, sort_keys=True)
+
+    index_file = _index_file(fingerprint)
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    with open(index_file, 'w') as fid:
+        fid.write(name)
+
+
+def lookup(fingerprint):
+    """Name of an existing install with this fingerprint, or None."""
+    try:
+        with open(_index_file(fingerprint), 'r') as fid:
+            name = fid.read().strip()
+    except OSError:
+        return None
+
+    # check the index isn't stale
+    if read(name) == fingerprint:
+        return name
+    return None
+
+
+def _submodule_commits(repo):
+    """Paths and checked out commits of all submodules.
+
+    Unlike git submodule status, this does not depend on the tags
+    fetched, which git describe annotates the commits with.
+    """
+    out = repo.git.submodule('foreach', '--quiet', '--recursive',
+                             'echo "$displaypath $(git rev-parse HEAD)"')
+    return sorted(line.split() for line in out.splitlines() if line.strip())
+
+
+def build_items(args, tpls_name):
+    """Everything that goes into an Amanzi or ATS build.
+
+    Returns None if the repo has local changes, as those cannot be
+    fingerprinted by commit.
+    """
+    repo = git.Repo(names.amanzi_src_dir(args.repo_kind, args.repo))
+    if repo.is_dirty(untracked_files=True, submodules=True):
+        logging.info('  repo has local changes, not fingerprinting the build')
+        return None
+
+    items = dict(kind=args.repo_kind,
+                 amanzi_commit=repo.head.commit.hexsha,
+                 submodule_commits=_submodule_commits(repo),
+                 tpls_fingerprint=read(tpls_name),
+                 build_type=args.build_type,
+                 build_static=args.build_static,
+                 enable_structured=args.enable_structured,
+                 enable_geochemistry=args.enable_geochemistry,
+                 bootstrap_options=' '.join(args.bootstrap_options.split()),
+                 python=sys.executable)
+    items.update(_compilers(args))
+    return items
@@ -0,0 +1,92 @@
+"""Memory governor for long builds.
+
+A MemoryGovernor watches the resident memory of a build's process
+tree.  When the total exceeds the limit, the most recently started
+leaf processes (the compilers and linkers doing the work) are paused
+with SIGSTOP, one per sample, so that the jobs already running can
+finish and release their memory.  Paused jobs are resumed, oldest
+first, once usage drops back below the resume fraction of the limit.
+At least one job is always left running, so the build can always make
+progress.
+"""
+import os
+import signal
+import threading
+import logging
+
+import ats_manager.proc as proc
+
+
+def default_memory_limit(fraction=0.9):
+    """Fraction of the currently available memory, in bytes."""
+    info = proc.meminfo()
+    return int(fraction * info.get('MemAvailable', info['MemTotal']))
+
+
+class MemoryGovernor(threading.Thread):
+    def __init__(self, pid, memory_limit, interval=1.0, resume_fraction=0.8):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.memory_limit = memory_limit
+        self.interval = interval
+        self.resume_fraction = resume_fraction
+        self.peak_rss = 0
+        self.num_paused = 0
+        self._paused = [] # list of (pid, starttime), oldest first
+        self._done = threading.Event()
+
+    def stop(self):
+        """Stops sampling and resumes anything that is still paused."""
+        self._done.set()
+        self.join()
+        for pid, _ in self._paused:
+            self._signal(pid, signal.SIGCONT)
+        self._paused = []
+        logging.info(f'  memory governor: peak RSS {self.peak_rss / 2**30:.1f} GB '
+                     f'of {self.memory_limit / 2**30:.1f} GB limit, paused {self.num_paused} jobs')
+
+    def _signal(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+            return True
+        except ProcessLookupError:
+            return False
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            try:
+                self._sample()
+            except Exception as err:
+                logging.warning(f'  memory governor: sampling failed: {err}')
+
+    def _sample(self):
+        tree = proc.process_tree(self.pid)
+        total = sum(proc.rss(pid) for pid, _, _ in tree)
+        self.peak_rss = max(self.peak_rss, total)
+
+        # forget paused jobs that have since exited (or been reused)
+        alive = set((pid, start) for pid, start, _ in tree)
+        self._paused = [p for p in self._paused if p in alive]
+
+        paused = set(self._paused)
+        running = sorted([(start, pid) for pid, start, is_leaf in tree
+                          if is_leaf and (pid, start) not in paused])
+
+        if len(running) == 0 and len(self._paused) > 0:
+            # everything left is paused, so nothing will free memory
+            pid, start = self._paused.pop(0)
+            logging.info(f'  memory governor: no running jobs, resuming pid {pid}')
+            self._signal(pid, signal.SIGCONT)
+
+        elif total > self.memory_limit:
+            if len(running) > 1:
+                start, pid = running[-1]
+                if self._signal(pid, signal.SIGSTOP):
+                    logging.info(f'  memory governor: RSS {total / 2**30:.1f} GB over limit, pausing pid {pid}')
+                    self._paused.append((pid, start))
+                    self.num_paused += 1
+
+        elif total < self.resume_fraction * self.memory_limit and len(self._paused) > 0:
+            pid, start = self._paused.pop(0)
+            logging.info(f'  memory governor: RSS {total / 2**30:.1f} GB, resuming pid {pid}')
+            self._signal(pid, signal.SIGCONT)
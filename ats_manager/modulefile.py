@@ -151,10 +151,30 @@ def modulefile_args(kind,
     if kind == 'ats':
         temp_pars['ats'] = name
         temp_pars['ats_src_dir'] = names.ats_src_dir(repo_version)
-        temp_pars['ats_regression_tests_dir'] = names.ats_regression_tests_dir(name)
+        temp_pars['ats_regression_tests_dir'] = names.ats_regression_tests_dir(repo_version)
     return temp_pars
     
 
+def read_modulefile(name):
+    """Reads the environment variables set by an existing modulefile.
+
+    Returns
+    -------
+    dict : variable name --> value, for each setenv in the modulefile
+    """
+    filename = names.modulefile_path(name)
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f'No modulefile for "{name}" at {filename}')
+
+    env = dict()
+    with open(filename, 'r') as fid:
+        for line in fid:
+            line = line.split()
+            if len(line) == 3 and line[0] == 'setenv':
+                env[line[1]] = line[2]
+    return env
+
+
 def _template_path(kind):
     """Returns the name of the template to be filled."""
     return os.path.join(os.environ['ATS_BASE'],'ats_manager','share',
@@ -31,6 +31,15 @@ def tpls_src_dir(kind, version):
 def ats_regression_tests_dir(version):
     return os.path.join(ats_src_dir(version), 'testing', 'ats-regression-tests')
 
+def mirror_dir(url):
+    """Location of the shared bare mirror of a remote repository."""
+    mirror = url.split('://')[-1]
+    if mirror.endswith('.git'):
+        mirror = mirror[:-4]
+    mirror = mirror.split('@')[-1]
+    mirror = clean(mirror.replace(':', '/').strip('/'))
+    return os.path.join(config['ATS_BASE'], 'mirrors', mirror+'.git')
+
 def tools_mpi_dir(vendor):
     return os.path.join(config['ATS_BASE'], 'tools', 'install', vendor)
 
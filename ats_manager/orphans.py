@@ -0,0 +1,157 @@
+"""Orphaned scripts, modulefiles, and build and install trees.
+
+Failed or aborted installs, and builds removed by hand, leave pieces
+behind that no longer match each other: bootstrap and make scripts in
+ATS_BASE/scripts, modulefiles in ATS_BASE/modulefiles, and install and
+build trees of the amanzi, ats, and amanzi-tpls kinds.  These are
+cross-referenced by name (see names.name): a build is complete when it
+has both a modulefile and an install, and everything else belonging
+to an incomplete build is an orphan, as is any script of a build that
+is not complete.
+
+Anything modified within min_age, or registered as building within
+min_age, may belong to an install in progress and is never an orphan.
+Nor is anything of a build registered as cleaned, which deliberately
+keeps its modulefile and scripts so that it can be rebuilt.
+"""
+import os
+import time
+import concurrent.futures
+import logging
+
+import ats_manager.names as names
+import ats_manager.utils as utils
+import ats_manager.registry as registry
+from ats_manager.config import config
+
+_kinds = ['amanzi', 'ats', 'amanzi-tpls']
+_script_prefixes = ['bootstrap', 'make_install', 'make_test']
+
+
+def _trees(root, depth=4):
+    """Names, relative to root, of build or install trees under root.
+
+    Trees are directories named by a build type, at least two and at
+    most depth levels down (version/[machine/][compilers/]build_type).
+    """
+    found = []
+    def walk(path, rel):
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_dir(follow_symlinks=False):
+                continue
+            sub = rel + [entry.name,]
+            if len(sub) >= 2 and entry.name in names.valid_build_types:
+                found.append('/'.join(sub))
+            elif len(sub) < depth:
+                walk(entry.path, sub)
+    walk(root, [])
+    return found
+
+
+def _modulefiles():
+    modulefiles = os.path.join(config['ATS_BASE'], 'modulefiles')
+    found = []
+    for kind in _kinds:
+        for root, dirs, files in os.walk(os.path.join(modulefiles, kind)):
+            found.extend(os.path.relpath(os.path.join(root, f), modulefiles) for f in files
+                         if not f.startswith('.'))
+    return found
+
+
+def _scripts():
+    scripts = os.path.join(config['ATS_BASE'], 'scripts')
+    if not os.path.isdir(scripts):
+        return []
+    return [entry.name for entry in os.scandir(scripts)
+            if entry.is_file(follow_symlinks=False) and entry.name.endswith('.sh')]
+
+
+def _script_build(script):
+    """Flattened build name of a script, or None if not one of ours."""
+    for prefix in _script_prefixes:
+        if script.startswith(prefix+'-'):
+            return script[len(prefix)+1:-len('.sh')]
+    return None
+
+
+def _mtime(path):
+    try:
+        return os.lstat(path).st_mtime
+    except OSError:
+        return 0
+
+
+def _size(path):
+    return utils.disk_usage(path)[0]
+
+
+def find(min_age=24*3600, jobs=8):
+    """Finds orphans, scanning all locations concurrently.
+
+    Returns a list of dicts with keys name (None for scripts), what
+    (install, build, modulefile, or script), path, reason, and size in
+    bytes, and the set of names of complete builds.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        installs = dict((kind, executor.submit(_trees, os.path.join(config['ATS_BASE'], kind, 'install')))
+                        for kind in _kinds)
+        builds = dict((kind, executor.submit(_trees, os.path.join(config['ATS_BUILD_BASE'], kind, 'build')))
+                      for kind in _kinds)
+        modulefiles = executor.submit(_modulefiles)
+        scripts = executor.submit(_scripts)
+
+        installs = set(f'{kind}/{tree}' for kind, f in installs.items() for tree in f.result())
+        builds = set(f'{kind}/{tree}' for kind, f in builds.items() for tree in f.result())
+        modulefiles = set(modulefiles.result())
+        scripts = scripts.result()
+
+    now = time.time()
+    building = dict((row['name'], row['updated']) for row in registry.query(status='building'))
+    cleaned = set(row['name'] for row in registry.query(status='cleaned'))
+    script_dir = os.path.join(config['ATS_BASE'], 'scripts')
+
+    complete = set()
+    in_progress = set()
+    kept = set()
+    orphans = []
+    for name in sorted(installs | builds | modulefiles):
+        if name in installs and name in modulefiles:
+            complete.add(name)
+            continue
+        if name in cleaned and name not in installs:
+            logging.info(f'  skipping {name}: cleaned, but kept to be rebuilt')
+            kept.add(name)
+            continue
+
+        paths = []
+        if name in installs:
+            paths.append(('install', names.install_dir(name)))
+        if name in builds:
+            paths.append(('build', names.build_dir(name)))
+        if name in modulefiles:
+            paths.append(('modulefile', names.modulefile_path(name)))
+
+        recent = [now - _mtime(path) for what, path in paths] + [now - building.get(name, 0),]
+        if min(recent) < min_age:
+            logging.info(f'  skipping {name}: may be in progress')
+            in_progress.add(name)
+            continue
+
+        reason = 'no modulefile' if name in installs else 'no install'
+        orphans.extend(dict(name=name, what=what, path=path, reason=reason) for what, path in paths)
+
+    keep = set(names.clean(name) for name in complete | in_progress | kept)
+    for script in sorted(scripts):
+        build = _script_build(script)
+        path = os.path.join(script_dir, script)
+        if build is not None and build not in keep and now - _mtime(path) >= min_age:
+            orphans.append(dict(name=None, what='script', path=path, reason='no build'))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for orphan, size in zip(orphans, executor.map(_size, [o['path'] for o in orphans])):
+            orphan['size'] = size
+    return orphans, complete
@@ -0,0 +1,115 @@
+"""Helpers for inspecting a process tree through /proc.
+
+These are Linux-only; on other platforms is_supported() returns False
+and callers should skip any monitoring.
+"""
+import os
+
+_page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+_clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def is_supported():
+    return os.path.isfile('/proc/self/stat')
+
+
+def _read_stat(pid):
+    """Returns the fields of /proc/pid/stat after the command name."""
+    with open(f'/proc/{pid}/stat', 'r') as fid:
+        data = fid.read()
+    # comm is in parentheses and may itself contain spaces or parentheses
+    return data[data.rfind(')')+2:].split()
+
+
+def meminfo():
+    """Dictionary of /proc/meminfo values, in bytes."""
+    info = dict()
+    with open('/proc/meminfo', 'r') as fid:
+        for line in fid:
+            key, val = line.split(':', 1)
+            val = val.split()
+            info[key] = int(val[0]) * 1024 if len(val) > 1 else int(val[0])
+    return info
+
+
+def _parents():
+    """Dictionary of pid --> (ppid, starttime) for all processes."""
+    parents = dict()
+    for entry in os.scandir('/proc'):
+        if entry.name.isdigit():
+            try:
+                stat = _read_stat(entry.name)
+            except (OSError, IndexError):
+                continue # process exited
+            parents[int(entry.name)] = (int(stat[1]), int(stat[19]))
+    return parents
+
+
+def process_tree(pid):
+    """List of (pid, starttime, is_leaf) for pid and all of its descendants.
+
+    pid may also be a list of pids, giving all of their trees.
+    """
+    parents = _parents()
+    children = dict()
+    for child, (ppid, _) in parents.items():
+        children.setdefault(ppid, []).append(child)
+
+    tree = []
+    stack = list(pid) if isinstance(pid, (list, tuple)) else [pid,]
+    while len(stack) > 0:
+        p = stack.pop()
+        if p not in parents:
+            continue
+        kids = children.get(p, [])
+        tree.append((p, parents[p][1], len(kids) == 0))
+        stack.extend(kids)
+    return tree
+
+
+def rss(pid):
+    """Resident set size of a single process, in bytes (0 if it exited)."""
+    try:
+        with open(f'/proc/{pid}/statm', 'r') as fid:
+            return int(fid.read().split()[1]) * _page_size
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def is_stopped(pid):
+    try:
+        return _read_stat(pid)[0] == 'T'
+    except (OSError, IndexError):
+        return False
+
+
+def cpu_time(pid):
+    """CPU seconds used by a process and its reaped children (0 if it exited).
+
+    Summed over the live processes of a tree, this counts every process
+    that has run in it, as a process's time moves to its parent's
+    children's time when it is reaped.
+    """
+    try:
+        stat = _read_stat(pid)
+        return sum(int(t) for t in stat[11:15]) / _clock_ticks
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+
+def io(pid):
+    """Dictionary of I/O counters of a process and its reaped children.
+
+    rchar/wchar count all reads and writes, including to network
+    filesystems; read_bytes/write_bytes count only block device I/O.
+    Empty if it exited or is not readable.
+    """
+    counters = dict()
+    try:
+        with open(f'/proc/{pid}/io', 'r') as fid:
+            for line in fid:
+                key, val = line.split(':', 1)
+                counters[key] = int(val)
+    except (OSError, ValueError):
+        pass
+    return counters
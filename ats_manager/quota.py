@@ -0,0 +1,147 @@
+"""Disk quota accounting and least-recently-used eviction.
+
+The disk use of every build is tracked in the registry (install_size,
+build_size) along with when it was last used (last_used: installed,
+updated, tested, or depended on).  When ATS_DISK_BUDGET is set, the
+total size of all build and install dirs is kept under it by evicting,
+least recently used first:
+
+  1. build trees, which are rarely needed once a build is installed,
+     those of failed builds first; then, only if asked,
+  2. whole installs that no remaining install depends on.
+
+Builds in progress are never evicted, though a build registered as
+building for more than a day is assumed to have been interrupted, and
+is treated as failed.  Eviction is done by evict() in
+ats_manager, through clean.remove_dir, either explicitly with
+bin/evict.py or before each install with --evict.
+"""
+import re
+import time
+import logging
+
+import ats_manager.registry as registry
+from ats_manager.config import config
+
+_units = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40, 'P': 2**50}
+_size_re = re.compile(r'^\s*([0-9.]+)\s*([KMGTP]?)i?B?\s*$', re.IGNORECASE)
+
+
+def parse_size(size):
+    """Bytes in a size string, e.g. '500G' or '1.5T'."""
+    match = _size_re.match(size)
+    if match is None:
+        raise ValueError(f'Invalid size: "{size}"')
+    return int(float(match.group(1)) * _units[match.group(2).upper()])
+
+
+def format_size(size):
+    if size >= 2**30:
+        return f'{size / 2**30:.1f} GB'
+    return f'{size / 2**20:.0f} MB'
+
+
+def budget():
+    """The configured budget, in bytes, or None if unlimited."""
+    size = config.get('ATS_DISK_BUDGET', '').strip()
+    if size == '':
+        return None
+    return parse_size(size)
+
+
+def auto_evict():
+    """Whether to evict before every install, see ATS_DISK_AUTO_EVICT."""
+    return config.getboolean('ATS_DISK_AUTO_EVICT', fallback=False)
+
+
+def in_progress(row, max_age=24*3600):
+    """Whether a build is in progress, as opposed to interrupted, i.e.
+    registered as building within max_age seconds."""
+    return row['status'] == 'building' and time.time() - (row['updated'] or 0) < max_age
+
+
+def builds(refresh=True):
+    """Registry rows of all builds that may use disk.
+
+    If refresh, builds not yet registered are registered and all sizes
+    are measured anew, rather than trusted from the last install.
+    """
+    if refresh:
+        registry.rescan()
+    rows = registry.query(where="status != 'removed'")
+    if refresh:
+        for row in rows:
+            if not in_progress(row):
+                row.update(registry.sizes(row['name']))
+                registry.update(row['name'], install_size=row['install_size'],
+                                build_size=row['build_size'])
+    return rows
+
+
+def usage(rows):
+    """Total bytes used by the build and install dirs of rows."""
+    return sum((row['install_size'] or 0) + (row['build_size'] or 0) for row in rows)
+
+
+def estimate(name, rows):
+    """Expected additional bytes a new build of name will use.
+
+    The median size of installed builds of the same kind, less what
+    name already uses, as it is rebuilt in place.
+    """
+    kind = name.split('/')[0]
+    totals = sorted((row['install_size'] or 0) + (row['build_size'] or 0) for row in rows
+                    if row['kind'] == kind and row['status'] == 'installed' and row['name'] != name)
+    if len(totals) == 0:
+        return 0
+    current = usage([row for row in rows if row['name'] == name])
+    return max(0, totals[len(totals) // 2] - current)
+
+
+def _last_used(row):
+    return row['last_used'] or row['updated'] or 0
+
+
+def plan(rows, budget, installs=False, keep=()):
+    """Evictions needed to bring rows under budget.
+
+    Returns a list of (what, name, bytes), in order, where what is
+    'build' (remove the build tree) or 'install' (remove the build
+    entirely).  The plan may not reach the budget if there is not
+    enough that can be evicted.
+    """
+    rows = dict((row['name'], dict(row)) for row in rows)
+    used = usage(rows.values())
+    evictions = []
+
+    # build trees, those of failed builds first
+    candidates = sorted((row for row in rows.values()
+                         if (row['build_size'] or 0) > 0 and not in_progress(row)
+                         and row['name'] not in keep),
+                        key=lambda row : (row['status'] not in ['failed', 'building'], _last_used(row)))
+    for row in candidates:
+        if used <= budget:
+            return evictions
+        evictions.append(('build', row['name'], row['build_size']))
+        used -= row['build_size']
+        row['build_size'] = 0
+
+    # whole installs that nothing remaining depends on; TPLs may become
+    # evictable as the builds using them are evicted
+    while used > budget and installs:
+        in_use = set(row['tpls_name'] for row in rows.values() if row['tpls_name'] is not None)
+        candidates = [row for row in rows.values()
+                      if (row['install_size'] or 0) > 0 and not in_progress(row)
+                      and row['name'] not in keep and row['name'] not in in_use]
+        if len(candidates) == 0:
+            break
+        row = min(candidates, key=_last_used)
+        evictions.append(('install', row['name'], row['install_size']))
+        used -= row['install_size']
+        rows.pop(row['name'])
+    return evictions
+
+
+def log_usage(rows, budget):
+    logging.info(f'Disk use: {format_size(usage(rows))} in {len(rows)} builds, '
+                 f'budget: {"unlimited" if budget is None else format_size(budget)}')
@@ -0,0 +1,222 @@
+"""Registry of installations.
+
+An SQLite database, ATS_REGISTRY (by default ATS_BASE/registry.db),
+holding one row per TPL, Amanzi, or ATS build: what it is, where it
+came from, what it depends on, and how it is doing.  It is updated by
+every install, update, and clean, so questions like "which builds use
+TPLs 0.98.x" or "which builds are at commit X" are answered without
+walking the filesystem.  Builds made before the registry existed can
+be added with rescan().
+
+Statuses are:
+
+  building  : an install is in progress (or was interrupted)
+  installed : the build succeeded (its tests may still have failed)
+  failed    : the build failed
+  cleaned   : the build and install dirs were removed
+  removed   : the build was removed entirely
+"""
+import os
+import time
+import sqlite3
+import contextlib
+import logging
+import git
+
+import ats_manager.names as names
+import ats_manager.utils as utils
+import ats_manager.modulefile as modulefile
+from ats_manager.config import config
+
+_columns = [
+    ('name', 'TEXT PRIMARY KEY'),
+    ('kind', 'TEXT'),            # ats, amanzi, or amanzi-tpls
+    ('version', 'TEXT'),         # build name, or TPLs version
+    ('repo', 'TEXT'),            # repo version the build is from
+    ('build_type', 'TEXT'),
+    ('machine', 'TEXT'),
+    ('compiler_id', 'TEXT'),
+    ('amanzi_commit', 'TEXT'),
+    ('ats_commit', 'TEXT'),
+    ('tpls_name', 'TEXT'),       # TPLs this build depends on
+    ('tpls_version', 'TEXT'),
+    ('fingerprint', 'TEXT'),
+    ('status', 'TEXT'),
+    ('test_rc', 'INTEGER'),
+    ('install_dir', 'TEXT'),
+    ('build_dir', 'TEXT'),
+    ('install_size', 'INTEGER'), # bytes
+    ('build_size', 'INTEGER'),   # bytes
+    ('build_seconds', 'REAL'),   # wall time of the last install or update
+    ('created', 'REAL'),
+    ('updated', 'REAL'),
+    ('last_used', 'REAL'),       # last installed, updated, or depended on
+]
+columns = [c for c, _ in _columns]
+_indexed = ['kind', 'tpls_name', 'tpls_version', 'amanzi_commit', 'ats_commit', 'status']
+
+
+def registry_file():
+    return config['ATS_REGISTRY']
+
+
+def connect():
+    """Connection to the registry, creating it if needed."""
+    filename = registry_file()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    db = sqlite3.connect(filename, timeout=60)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS builds ({})'.format(
+        ', '.join(f'{c} {t}' for c, t in _columns)))
+
+    # columns added since the registry was created
+    existing = [row['name'] for row in db.execute('PRAGMA table_info(builds)')]
+    for c, t in _columns:
+        if c not in existing:
+            db.execute(f'ALTER TABLE builds ADD COLUMN {c} {t}')
+    for c in _indexed:
+        db.execute(f'CREATE INDEX IF NOT EXISTS builds_{c} ON builds ({c})')
+    db.commit()
+    return db
+
+
+@contextlib.contextmanager
+def _transaction():
+    db = connect()
+    try:
+        with db:
+            yield db
+    finally:
+        db.close()
+
+
+def update(name, **fields):
+    """Creates or updates the row of build name."""
+    for key in fields:
+        if key not in columns:
+            raise KeyError(f'Not a registry column: {key}')
+    now = time.time()
+    fields['updated'] = now
+    fields.setdefault('kind', name.split('/')[0])
+    keys = list(fields.keys())
+    with _transaction() as db:
+        db.execute('INSERT INTO builds (name, created, {}) VALUES (?, ?, {}) '
+                   'ON CONFLICT(name) DO UPDATE SET {}'.format(
+                       ', '.join(keys), ', '.join('?' for k in keys),
+                       ', '.join(f'{k}=excluded.{k}' for k in keys)),
+                   [name, now] + [fields[k] for k in keys])
+
+
+def touch(name):
+    """Marks a build as just used."""
+    with _transaction() as db:
+        db.execute('UPDATE builds SET last_used=? WHERE name=?', (time.time(), name))
+
+
+def get(name):
+    """The row of build name, as a dict, or None."""
+    with _transaction() as db:
+        row = db.execute('SELECT * FROM builds WHERE name=?', (name,)).fetchone()
+    return None if row is None else dict(row)
+
+
+def query(where=None, params=(), order='name', **filters):
+    """Rows matching the filters, as dicts.
+
+    Each filter is a column and a value, which may be a glob pattern
+    (e.g. tpls_version='0.98.*').  Commit filters also match on a
+    prefix of the hash.  where is an additional raw SQL condition.
+    """
+    conditions = []
+    values = []
+    for key, val in filters.items():
+        if val is None:
+            continue
+        if key not in columns:
+            raise KeyError(f'Not a registry column: {key}')
+        if key.endswith('_commit'):
+            val = val + '*'
+        conditions.append(f'{key} GLOB ?')
+        values.append(val)
+    if where is not None:
+        conditions.append(f'({where})')
+        values.extend(params)
+
+    sql = 'SELECT * FROM builds'
+    if len(conditions) > 0:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += f' ORDER BY {order}'
+    with _transaction() as db:
+        return [dict(row) for row in db.execute(sql, values)]
+
+
+def sizes(name):
+    """Current install and build dir sizes of a build."""
+    return dict(install_size=utils.disk_usage(names.install_dir(name))[0],
+                build_size=utils.disk_usage(names.build_dir(name))[0])
+
+
+def commits(kind, repo):
+    """Amanzi and ATS commits of a repo, as far as they can be found."""
+    found = dict()
+    try:
+        found['amanzi_commit'] = git.Repo(names.amanzi_src_dir(kind, repo)).head.commit.hexsha
+        if kind == 'ats':
+            found['ats_commit'] = git.Repo(names.ats_src_dir(repo)).head.commit.hexsha
+    except (git.exc.GitError, ValueError, OSError):
+        pass
+    return found
+
+
+def rescan():
+    """Registers all builds with a modulefile that are not yet registered.
+
+    Returns the names of newly registered builds.
+    """
+    modulefiles = os.path.join(config['ATS_BASE'], 'modulefiles')
+    added = []
+    for root, dirs, files in os.walk(modulefiles):
+        for f in files:
+            name = os.path.relpath(os.path.join(root, f), modulefiles)
+            if get(name) is not None:
+                continue
+            parts = name.split('/')
+            status = 'installed' if os.path.isdir(names.install_dir(name)) else 'cleaned'
+            fields = dict(kind=parts[0], version=parts[1],
+                          build_type=parts[-1], status=status,
+                          last_used=os.path.getmtime(os.path.join(root, f)),
+                          install_dir=names.install_dir(name),
+                          build_dir=names.build_dir(name))
+            try:
+                env = modulefile.read_modulefile(name)
+            except OSError:
+                env = dict()
+            if 'AMANZI_SRC_DIR' in env:
+                fields['repo'] = os.path.basename(env['AMANZI_SRC_DIR'])
+                fields.update(commits(parts[0], fields['repo']))
+            fields.update(sizes(name))
+            update(name, **fields)
+            logging.info(f'  registered {name} ({status})')
+            added.append(name)
+    return added
+
+
+def format_table(rows, fields):
+    """Rows as lines of a fixed-width table."""
+    def fmt(key, val):
+        if val is None:
+            return ''
+        if key.endswith('_size'):
+            return f'{val / 2**30:.1f}G' if val >= 2**30 else f'{val / 2**20:.0f}M'
+        if key.endswith('_commit'):
+            return val[0:10]
+        if key in ['created', 'updated', 'last_used']:
+            return time.strftime('%Y-%m-%d %H:%M', time.localtime(val))
+        if key == 'build_seconds':
+            return f'{val / 60:.0f}m'
+        return str(val)
+
+    table = [list(fields),] + [[fmt(f, row[f]) for f in fields] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(fields))]
+    return ['  '.join(val.ljust(w) for val, w in zip(line, widths)).rstrip() for line in table]
@@ -0,0 +1,335 @@
+"""Remote backends for the packed install cache.
+
+ATS_CACHE_URL in ats_manager.cfg points at a shared cache, either a
+directory (a path or file:// URL, e.g. on a filesystem mounted by all
+machines) or an HTTP server accepting GET and PUT, such as the one run
+by bin/cache_server.py.
+
+Archives are pushed in the background after they are packed, and
+pulled when a restore misses the local cache.  Each archive has a
+.sha256 file next to it, which is checked on every pull.  HTTP pulls
+download several byte ranges of an archive concurrently.
+
+PUTs to the cache server are not authenticated, so it listens only on
+localhost unless told otherwise, and never overwrites an existing file:
+archives are named by their configuration, so once pushed they are
+never changed.
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import logging
+import concurrent.futures
+import urllib.request
+import urllib.error
+import http.server
+
+from ats_manager.config import config
+
+_extensions = ['.tar.zst', '.tar.gz']
+_transfers = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+_pending = []
+_pending_lock = threading.Lock()
+
+
+def sha256sum(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(2**20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class DirectoryBackend:
+    """Cache in a directory, typically on a shared filesystem."""
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def exists(self, fname):
+        return os.path.isfile(os.path.join(self.path, fname))
+
+    def read_text(self, fname):
+        with open(os.path.join(self.path, fname), 'r') as fid:
+            return fid.read()
+
+    def get(self, fname, dest):
+        shutil.copyfile(os.path.join(self.path, fname), dest)
+
+    def put(self, src, fname):
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.'+fname, dir=self.path)
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, os.path.join(self.path, fname))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+class HTTPBackend:
+    """Cache on an HTTP server supporting GET (with Range) and PUT."""
+    def __init__(self, url, jobs=4, chunk_size=64 * 2**20):
+        self.url = url.rstrip('/')
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+
+    def __str__(self):
+        return self.url
+
+    def _request(self, fname, method='GET', headers=None, data=None):
+        request = urllib.request.Request(f'{self.url}/{fname}', method=method,
+                                         headers=headers if headers is not None else dict(),
+                                         data=data)
+        return urllib.request.urlopen(request, timeout=60)
+
+    def exists(self, fname):
+        try:
+            with self._request(fname, 'HEAD'):
+                return True
+        except urllib.error.HTTPError as err:
+            if err.code == 404:
+                return False
+            raise
+
+    def read_text(self, fname):
+        with self._request(fname) as response:
+            return response.read().decode('utf-8')
+
+    def _get_range(self, fname, dest, start, end):
+        with self._request(fname, headers={'Range' : f'bytes={start}-{end}'}) as response:
+            if response.status != 206:
+                raise RuntimeError(f'Server ignored range request for {fname}')
+            with open(dest, 'r+b') as fid:
+                fid.seek(start)
+                shutil.copyfileobj(response, fid, 2**20)
+
+    def get(self, fname, dest):
+        with self._request(fname, 'HEAD') as response:
+            size = int(response.headers.get('Content-Length', -1))
+            ranges = response.headers.get('Accept-Ranges', 'none') == 'bytes'
+
+        if not ranges or size < 2 * self.chunk_size:
+            with self._request(fname) as response, open(dest, 'wb') as fid:
+                shutil.copyfileobj(response, fid, 2**20)
+            return
+
+        with open(dest, 'wb') as fid:
+            fid.truncate(size)
+        chunks = [(start, min(start + self.chunk_size, size) - 1)
+                  for start in range(0, size, self.chunk_size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(self._get_range, fname, dest, start, end)
+                       for start, end in chunks]
+            for future in futures:
+                future.result()
+
+    def put(self, src, fname):
+        with open(src, 'rb') as fid:
+            headers = {'Content-Length' : str(os.path.getsize(src))}
+            try:
+                with self._request(fname, 'PUT', headers=headers, data=fid):
+                    pass
+            except urllib.error.HTTPError as err:
+                if err.code != 409:
+                    raise
+                # already pushed, e.g. concurrently by another machine
+                logging.info(f'  {fname} already in {self}')
+
+
+def get_backend(url=None):
+    """Backend for url, by default ATS_CACHE_URL, or None if unset."""
+    if url is None:
+        url = config.get('ATS_CACHE_URL', '')
+    if url == '':
+        return None
+    if url.startswith('http://') or url.startswith('https://'):
+        return HTTPBackend(url)
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return DirectoryBackend(url)
+
+
+def pull(key, cache_dir):
+    """Downloads the archive for key into cache_dir, checking its sha256.
+
+    Returns the path of the downloaded archive, or None.
+    """
+    backend = get_backend()
+    if backend is None:
+        return None
+
+    for ext in _extensions:
+        fname = key+ext
+        try:
+            if not backend.exists(fname):
+                continue
+            logging.info(f'Pulling {fname}')
+            logging.info(f'   from: {backend}')
+            expected = backend.read_text(fname+'.sha256').split()[0]
+
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix='.'+fname, dir=cache_dir)
+            os.close(fd)
+            try:
+                backend.get(fname, tmp)
+                if sha256sum(tmp) != expected:
+                    logging.warning(f'  checksum mismatch for {fname}, not using it')
+                    return None
+                archive = os.path.join(cache_dir, fname)
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, archive)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            return archive
+        except (OSError, urllib.error.URLError, RuntimeError) as err:
+            logging.warning(f'  pulling {fname} failed: {err}')
+            return None
+    return None
+
+
+def _push(archive):
+    backend = get_backend()
+    fname = os.path.basename(archive)
+    try:
+        if backend.exists(fname):
+            logging.info(f'  {fname} already in {backend}')
+            return True
+        sha_file = archive+'.sha256'
+        with open(sha_file, 'w') as fid:
+            fid.write(f'{sha256sum(archive)}  {fname}\n')
+
+        # archive first, so a checksum never refers to a missing archive
+        backend.put(archive, fname)
+        backend.put(sha_file, fname+'.sha256')
+        logging.info(f'  pushed {fname} to {backend}')
+        return True
+    except (OSError, urllib.error.URLError) as err:
+        logging.warning(f'  pushing {fname} to {backend} failed: {err}')
+        return False
+
+
+def push(archive):
+    """Uploads an archive in the background, if a remote cache is set.
+
+    Pending pushes are finished before the interpreter exits; call
+    wait() to block on them earlier.
+    """
+    if get_backend() is None:
+        return None
+    future = _transfers.submit(_push, archive)
+    with _pending_lock:
+        _pending.append(future)
+    return future
+
+
+def wait():
+    """Blocks until all pending pushes are done."""
+    with _pending_lock:
+        pending = list(_pending)
+        _pending.clear()
+    return all(future.result() for future in pending)
+
+
+class CacheRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves a cache directory, adding PUT and byte-range GET."""
+    def do_PUT(self):
+        path = self.translate_path(self.path)
+        if os.path.basename(path).startswith('.') or os.path.isdir(path):
+            self.send_error(403)
+            return
+        if os.path.exists(path):
+            self.close_connection = True
+            self.send_error(409, 'Already exists')
+            return
+        length = int(self.headers['Content-Length'])
+        fd, tmp = tempfile.mkstemp(prefix='.upload-', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fid:
+                while length > 0:
+                    chunk = self.rfile.read(min(length, 2**20))
+                    if not chunk:
+                        break
+                    fid.write(chunk)
+                    length -= len(chunk)
+            if length > 0:
+                self.send_error(400, 'Incomplete upload')
+                return
+            os.chmod(tmp, 0o644)
+            try:
+                # unlike a rename, fails if another upload got there first
+                os.link(tmp, path)
+            except FileExistsError:
+                self.send_error(409, 'Already exists')
+                return
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def do_GET(self):
+        byte_range = self.headers.get('Range', None)
+        path = self.translate_path(self.path)
+        if byte_range is None or not byte_range.startswith('bytes=') or not os.path.isfile(path):
+            return super().do_GET()
+
+        size = os.path.getsize(path)
+        try:
+            start, end = byte_range[len('bytes='):].split('-')
+            if start == '':
+                # suffix range, the last end bytes
+                start = max(0, size - int(end))
+                end = size - 1
+            else:
+                start = int(start)
+                end = min(int(end), size - 1) if end != '' else size - 1
+        except ValueError:
+            # malformed, or multiple ranges, which are not supported
+            start, end = 0, -1
+        if start > end or start < 0:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with open(path, 'rb') as fid:
+            fid.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = fid.read(min(remaining, 2**20))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+def serve(directory, port=8000, bind='127.0.0.1'):
+    """Runs a cache server for directory until interrupted.
+
+    Anyone who can reach the server can push archives, so bind to
+    other interfaces only on a trusted network.
+    """
+    os.makedirs(directory, exist_ok=True)
+    handler = lambda *args, **kwargs: CacheRequestHandler(*args, directory=directory, **kwargs)
+    with http.server.ThreadingHTTPServer((bind, port), handler) as server:
+        logging.info(f'Serving cache {directory} on {bind}:{port}')
+        server.serve_forever()
@@ -1,13 +1,52 @@
 import os, shutil
 import logging
+import concurrent.futures
 import git
 
 import ats_manager.names as names
 import ats_manager.utils as utils
+import ats_manager.clean as ats_clean
 from ats_manager.config import config
 
-def clone(name, url, path, branch='master'):
-    """Generic clone helper"""
+def update_mirror(url):
+    """Creates or fetches the shared bare mirror of url, returning its path.
+
+    Mirrors live in ATS_BASE/mirrors and are used as the object store
+    for --reference clones.  Clones borrow objects from them through
+    git alternates, so objects must never be pruned, even when forced
+    fetches leave them unreachable: automatic gc is disabled and
+    pruning of unreachable objects never expires.
+    """
+    path = names.mirror_dir(url)
+    if os.path.isdir(path):
+        logging.info(f'Fetching mirror: {path}')
+        mirror = git.Repo(path)
+        _protect_mirror(mirror)
+        mirror.git.fetch('origin')
+    else:
+        logging.info(f'Creating mirror of {url}')
+        logging.info(f'     at: {path}')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        mirror = git.Repo.clone_from(url, path, mirror=True)
+        _protect_mirror(mirror)
+    return path
+
+
+def _protect_mirror(mirror):
+    """Keeps git from pruning objects that clones may borrow."""
+    with mirror.config_writer() as writer:
+        writer.set_value('gc', 'auto', '0')
+        writer.set_value('gc', 'pruneExpire', 'never')
+        writer.set_value('gc', 'reflogExpireUnreachable', 'never')
+
+
+def clone(name, url, path, branch='master', use_mirror=False,
+          depth=None, clone_filter=None):
+    """Generic clone helper
+
+    depth and clone_filter (e.g. 'blob:none') make shallow and partial
+    clones, respectively.  Use deepen() to get the full history later.
+    """
     if os.path.exists(path):
         raise RuntimeError("Cannot clone into {} as it already exists.".format(path))
 
@@ -15,37 +54,284 @@ def clone(name, url, path, branch='master'):
     logging.info('   from: {}'.format(url))
     logging.info('     to: {}'.format(path))
     logging.info(' branch: {}'.format(branch))
-    repo = git.Repo.clone_from(url, path, branch=branch)
+
+    kwargs = dict()
+    if use_mirror:
+        kwargs['reference'] = update_mirror(url)
+        logging.info('    ref: {}'.format(kwargs['reference']))
+    if depth is not None:
+        kwargs['depth'] = depth
+        logging.info('  depth: {}'.format(depth))
+    if clone_filter is not None:
+        kwargs['filter'] = clone_filter
+        logging.info(' filter: {}'.format(clone_filter))
+    repo = git.Repo.clone_from(url, path, branch=branch, **kwargs)
     utils.chmod(path)
     return repo
 
 
-def clone_amanzi(path, branch='master'):
+def _submodule_url(parent, sub):
+    """URL of a submodule, resolving URLs relative to the parent's origin."""
+    url = sub.url
+    if url.startswith('./') or url.startswith('../'):
+        base = parent.remotes.origin.url.rstrip('/')
+        for part in url.split('/'):
+            if part == '..':
+                base = base.rsplit('/', 1)[0]
+            elif part != '.':
+                base = base + '/' + part
+        url = base
+    return url
+
+
+def update_submodule(parent, sub, use_mirror=False, init=True,
+                     depth=None, clone_filter=None, force=False):
+    """Initializes and checks out a single (non-recursive) submodule.
+
+    If force, local changes in the submodule are thrown away.
+    """
+    args = ['update']
+    if init:
+        args.append('--init')
+    if force:
+        args.append('--force')
+    if use_mirror:
+        args += ['--reference', update_mirror(_submodule_url(parent, sub))]
+    if depth is not None:
+        args.append('--depth={}'.format(depth))
+    if clone_filter is not None:
+        args.append('--filter={}'.format(clone_filter))
+    parent.git.submodule(*args, '--', sub.path)
+
+
+def update_submodules(parent, use_mirror=False, jobs=4,
+                      depth=None, clone_filter=None, force=False):
+    """Checks out all (direct) submodules of parent concurrently.
+
+    Submodules are first initialized serially, as that writes to the
+    parent's config, then fetched and checked out by a pool of jobs
+    workers.  Failures are logged per submodule, and a RuntimeError
+    listing all failed submodules is raised once every submodule has
+    been attempted.
+    """
+    subs = parent.submodules
+    if len(subs) == 0:
+        return
+    parent.git.submodule('init')
+
+    def _update(sub):
+        logging.info('Checking out submodule {}'.format(sub))
+        update_submodule(parent, sub, use_mirror, init=False,
+                         depth=depth, clone_filter=clone_filter, force=force)
+
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [executor.submit(_update, sub) for sub in subs]
+        for sub, future in zip(subs, futures):
+            try:
+                future.result()
+            except Exception as err:
+                logging.error('Failed checking out submodule {}: {}'.format(sub, err))
+                failures.append(sub.name)
+            else:
+                logging.info('  checked out submodule {}'.format(sub))
+
+    if len(failures) > 0:
+        raise RuntimeError('Failed checking out submodules: {}'.format(', '.join(failures)))
+
+
+def clone_amanzi(path, branch='master', use_mirror=False,
+                 depth=None, clone_filter=None):
     """Clones a new copy of an Amanzi branch."""
-    return clone('Amanzi', config['AMANZI_URL'], path, branch)
+    return clone('Amanzi', config['AMANZI_URL'], path, branch, use_mirror,
+                 depth, clone_filter)
+
 
+def clone_amanzi_ats(path, branch='master', ats_branch=None, use_mirror=False,
+                     clone_jobs=4, depth=None, clone_filter=None):
+    """Clones a new copy of an Amanzi branch that includes ATS.
 
-def clone_amanzi_ats(path, branch='master', ats_branch=None):
-    """Clones a new copy of an Amanzi branch that includes ATS."""
-    repo = clone('Amanzi-ATS', config['AMANZI_URL'], path, branch)
+    ATS's own submodules are checked out concurrently, clone_jobs at a
+    time.
+    """
+    repo = clone('Amanzi-ATS', config['AMANZI_URL'], path, branch, use_mirror,
+                 depth, clone_filter)
     logging.info('Cloning submodules (ATS).')
 
     ats_sub = repo.submodule(names.ats_submodule)
-    ats_sub.update(init=True, recursive=False)
+    update_submodule(repo, ats_sub, use_mirror, depth=depth, clone_filter=clone_filter)
 
     if ats_branch is not None:
         logging.info('Checking out ATS branch: {}'.format(ats_branch))
-        ats_sub.module().git.checkout(ats_branch)
-        ats_sub.module().git.pull()
+        if is_shallow(ats_sub.module()):
+            # only the submodule's commit was fetched, get the branch tip;
+            # it may be shallow by .gitmodules, without a depth given
+            ats_sub.module().git.fetch('--depth={}'.format(1 if depth is None else depth),
+                                       'origin', ats_branch)
+            ats_sub.module().git.checkout('-B', ats_branch, 'FETCH_HEAD')
+        else:
+            ats_sub.module().git.checkout(ats_branch)
+            ats_sub.module().git.pull()
 
     # clone ats submodules
-    for sub in ats_sub.module().submodules:
-        logging.info('Checking out ATS submodule {}'.format(sub))
-        sub.update(init=True)
+    logging.info('Cloning ATS submodules.')
+    update_submodules(ats_sub.module(), use_mirror, clone_jobs, depth, clone_filter)
     return repo
 
 
+def reset_to(repo, ref, depth=None):
+    """Fetches ref from origin and hard-resets the working tree to it.
+
+    Branches are checked out (and reset) as a local branch tracking
+    origin, anything else (hashes, tags) is checked out detached.
+    Untracked files are removed.  depth only applies to repos that are
+    already shallow.
+    """
+    if depth is None or not is_shallow(repo):
+        depth_args = []
+    else:
+        depth_args = ['--depth={}'.format(depth)]
+    try:
+        # branches get a remote-tracking ref, even in single-branch clones
+        repo.git.fetch(*depth_args, 'origin',
+                       '+refs/heads/{0}:refs/remotes/origin/{0}'.format(ref))
+    except git.exc.GitCommandError:
+        is_branch = False
+    else:
+        is_branch = True
+
+    if is_branch:
+        repo.git.checkout('-f', '-B', ref, 'origin/{}'.format(ref))
+    else:
+        try:
+            repo.git.fetch(*depth_args, 'origin', ref)
+            target = 'FETCH_HEAD'
+        except git.exc.GitCommandError:
+            # some servers refuse fetching an unadvertised hash
+            repo.git.fetch('origin')
+            target = ref
+        repo.git.checkout('-f', '--detach', target)
+    repo.git.clean('-ffd')
+
+
+def update_amanzi_ats(path, branch='master', ats_branch=None, clone_jobs=4, depth=None):
+    """Moves an existing Amanzi-ATS clone to new branches in place.
+
+    Fetches and hard-resets the superproject to branch, then ATS to
+    ats_branch (or the commit recorded in the superproject if None),
+    then ATS's submodules to their recorded commits.  Local changes and
+    untracked files are removed everywhere.
+    """
+    logging.info('Updating Amanzi-ATS in place')
+    logging.info('     at: {}'.format(path))
+    logging.info(' branch: {}'.format(branch))
+    repo = git.Repo(path)
+    reset_to(repo, branch, depth)
+
+    repo.git.submodule('sync')
+    ats_sub = repo.submodule(names.ats_submodule)
+    update_submodule(repo, ats_sub, depth=depth, force=True)
+    ats_repo = ats_sub.module()
+    if ats_branch is not None:
+        logging.info('Resetting ATS to branch: {}'.format(ats_branch))
+        reset_to(ats_repo, ats_branch, depth)
+    else:
+        ats_repo.git.clean('-ffd')
+
+    logging.info('Updating ATS submodules.')
+    ats_repo.git.submodule('sync')
+    update_submodules(ats_repo, jobs=clone_jobs, depth=depth, force=True)
+    for sub in ats_repo.submodules:
+        sub.module().git.clean('-ffd')
+    return repo
+
+
+def _changed_files(repo, old_commit, prefix=''):
+    """Files changed between old_commit and HEAD."""
+    changed = repo.git.diff('--name-only', old_commit, 'HEAD').split('\n')
+    return [os.path.join(prefix, f) for f in changed if f != '']
+
+
+def incoming_changes(path):
+    """Fetches an existing Amanzi clone and returns the files, relative
+    to path, that pulling its current branch would change (but does not
+    pull).  Empty if Amanzi is not on a branch tracking a remote one."""
+    repo = git.Repo(path)
+    if repo.head.is_detached:
+        return []
+    tracking = repo.active_branch.tracking_branch()
+    if tracking is None:
+        return []
+    repo.git.fetch(tracking.remote_name)
+    return [f for f in repo.git.diff('--name-only', f'HEAD...{tracking.name}').splitlines() if f != '']
+
+
+def pull_amanzi_ats(path, clone_jobs=4):
+    """Pulls the current branches of an existing Amanzi-ATS clone.
+
+    Amanzi and ATS are fast-forwarded if they are on a branch.  If ATS
+    is detached, it is moved to the commit recorded in Amanzi.  ATS's
+    submodules are then moved to the commits recorded in ATS.
+
+    Returns
+    -------
+    git.Repo : the Amanzi repo
+    list : files, relative to path, changed by the pull
+    """
+    logging.info('Pulling Amanzi-ATS')
+    logging.info('     at: {}'.format(path))
+    repo = git.Repo(path)
+    old_commit = repo.head.commit.hexsha
+    if repo.head.is_detached:
+        logging.info('  Amanzi is not on a branch, not pulling')
+    else:
+        repo.git.pull('--ff-only')
+    changed = _changed_files(repo, old_commit)
+
+    ats_sub = repo.submodule(names.ats_submodule)
+    if ats_sub.module_exists():
+        ats_repo = ats_sub.module()
+        old_commit = ats_repo.head.commit.hexsha
+        if ats_repo.head.is_detached:
+            logging.info('  ATS is not on a branch, updating to the submodule commit')
+            update_submodule(repo, ats_sub)
+        else:
+            ats_repo.git.pull('--ff-only')
+        changed.extend(_changed_files(ats_repo, old_commit, names.ats_submodule))
+        update_submodules(ats_repo, jobs=clone_jobs)
+
+    logging.info('  {} files changed'.format(len(changed)))
+    return repo, changed
+
+
+def _is_corrupt(err):
+    """Does this git error indicate a broken repository (vs e.g. network)?"""
+    if isinstance(err, (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError)):
+        return True
+    msg = str(err).lower()
+    return any(pattern in msg for pattern in ['not a git repository', 'corrupt',
+                                               'bad object', 'loose object',
+                                               'unable to read', 'broken link'])
+
+
+def is_shallow(repo):
+    """Is this a shallow (depth-limited) clone?"""
+    return repo.git.rev_parse('--is-shallow-repository') == 'true'
+
+
+def deepen(repo):
+    """Fetches the full history of a shallow and/or single-branch clone.
+
+    Blobs of partial (--filter) clones are still fetched on demand.
+    """
+    if is_shallow(repo):
+        logging.info(f'   fetching full history of: {repo.working_dir}')
+        repo.git.config('remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*')
+        repo.git.fetch('--unshallow', 'origin')
+
+
 def create_new_branch(repo, branch):
+    deepen(repo)
     repo.git.checkout('-b', branch)
 
 
@@ -55,31 +341,63 @@ def get_repo(repo_kind, repo_version,
              amanzi_branch=None,
              ats_branch=None,
              new_amanzi_branch=None,
-             new_ats_branch=None):
-    """Check or clone a repo, returns the path to the repo"""
+             new_ats_branch=None,
+             use_mirror=False,
+             clone_jobs=4,
+             depth=None,
+             clone_filter=None,
+             update=False):
+    """Check or clone a repo, returns the path to the repo
+
+    If use_mirror, the repo and its submodules are cloned with
+    --reference to shared mirrors in ATS_BASE/mirrors, so that only
+    the first clone of each repository hits the network and disk.
+
+    depth and clone_filter make shallow and partial clones of the repo
+    and its submodules.  Repos are deepened to their full history when
+    a new branch is created.
+
+    If update and the repo exists, it is fetched and reset to the
+    requested branches in place (see update_amanzi_ats), recloning only
+    if the existing repo is broken.
+    """
     amanzi_repo_path = names.amanzi_src_dir(repo_kind, repo_version)
     logging.info(f'Setting up repo at: {amanzi_repo_path}')
     logging.info(f'   skip_clone = {skip_clone}, clobber = {clobber}')
     
+    if amanzi_branch is None:
+        amanzi_branch = repo_version
+
+    amanzi_repo = None
     if skip_clone:
         amanzi_repo = git.Repo(amanzi_repo_path)
-    else:
+    elif update and os.path.exists(amanzi_repo_path):
+        logging.info(f'   updating to branches: {amanzi_branch}, {ats_branch}')
+        try:
+            amanzi_repo = update_amanzi_ats(amanzi_repo_path, amanzi_branch, ats_branch,
+                                            clone_jobs, depth)
+        except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError,
+                git.exc.GitCommandError) as err:
+            if not _is_corrupt(err):
+                raise
+            logging.warning(f'   repo appears to be broken, recloning: {err}')
+            clobber = True
+
+    if amanzi_repo is None:
         if clobber:
             logging.info(f'   clobbering dir: {amanzi_repo_path}')
             ats_clean.remove_dir(amanzi_repo_path, True)
 
-        if amanzi_branch is None:
-            amanzi_branch = repo_version
-
         logging.info(f'   switching to branches: {amanzi_branch}, {ats_branch}')
-        amanzi_repo = clone_amanzi_ats(amanzi_repo_path, amanzi_branch, ats_branch)
+        amanzi_repo = clone_amanzi_ats(amanzi_repo_path, amanzi_branch, ats_branch,
+                                       use_mirror, clone_jobs, depth, clone_filter)
 
     if new_amanzi_branch is not None:
         logging.info(f'   creating Amanzi branch: {new_amanzi_branch}')
-        amanzi_repo.git.checkout('-b', new_amanzi_branch)
+        create_new_branch(amanzi_repo, new_amanzi_branch)
     if new_ats_branch is not None:
         logging.info(f'   creating ATS branch: {new_ats_branch}')
-        amanzi_repo.submodule(names.ats_submodule).module().git.checkout('-b', new_ats_branch)
+        create_new_branch(amanzi_repo.submodule(names.ats_submodule).module(), new_ats_branch)
 
     utils.chmod(amanzi_repo_path)
     return amanzi_repo
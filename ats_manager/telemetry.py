@@ -0,0 +1,111 @@
+"""Resource telemetry of builds and tests.
+
+A Telemetry sampler records, at a fixed interval, the resource use of
+a process tree: CPU cores in use, resident memory, I/O, and number of
+processes.  Samples are written as CSV, one row per sample:
+
+  time      : seconds since sampling started
+  procs     : number of processes in the tree
+  cpu       : CPU cores in use, averaged over the interval
+  rss       : total resident memory, in bytes
+  rchar     : bytes read (all reads, including network filesystems)
+  wchar     : bytes written (all writes, including network filesystems)
+  read_bytes, write_bytes : bytes read from/written to block devices
+
+The tree sampled is that of a single pid, or of the pids returned by a
+callable at each sample, for a set of processes that changes over time.
+I/O columns are cumulative since sampling started.  Comparing cpu to
+the number of build jobs shows whether a build is CPU-bound; low cpu
+with climbing rchar/wchar suggests it is waiting on the filesystem,
+and rss near the memory limit that it is memory-bound.
+"""
+import os
+import time
+import threading
+import logging
+
+import ats_manager.proc as proc
+
+_io_keys = ['rchar', 'wchar', 'read_bytes', 'write_bytes']
+_columns = ['time', 'procs', 'cpu', 'rss'] + _io_keys
+
+
+class Telemetry(threading.Thread):
+    def __init__(self, pid, filename, interval=5.0):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.filename = filename
+        self.interval = interval
+        self.num_samples = 0
+        self.elapsed = 0.0
+        self.peak_rss = 0
+        self.peak_procs = 0
+        self.peak_cpu = 0.0
+        self.cpu_seconds = 0.0
+        self.io = dict((k, 0) for k in _io_keys)
+        self._done = threading.Event()
+
+    def stop(self):
+        """Stops sampling and logs a summary."""
+        self._done.set()
+        self.join()
+        avg_cpu = self.cpu_seconds / self.elapsed if self.elapsed > 0 else 0.0
+        logging.info(f'  telemetry: {avg_cpu:.1f} cores average, {self.peak_cpu:.1f} peak, '
+                     f'peak RSS {self.peak_rss / 2**30:.1f} GB, peak {self.peak_procs} processes, '
+                     f'read {self.io["rchar"] / 2**30:.1f} GB, wrote {self.io["wchar"] / 2**30:.1f} GB')
+        logging.info(f'  telemetry: {self.filename}')
+
+    def _tree(self):
+        return proc.process_tree(self.pid() if callable(self.pid) else self.pid)
+
+    def _totals(self, tree):
+        cpu = 0.0
+        io = dict((k, 0) for k in _io_keys)
+        rss = 0
+        for pid, _, _ in tree:
+            cpu += proc.cpu_time(pid)
+            rss += proc.rss(pid)
+            counters = proc.io(pid)
+            for k in _io_keys:
+                io[k] += counters.get(k, 0)
+        return cpu, rss, io
+
+    def run(self):
+        start = time.time()
+        last_time = start
+        try:
+            last_cpu, _, first_io = self._totals(self._tree())
+        except OSError:
+            return
+
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename, 'w') as fid:
+            fid.write(','.join(_columns) + '\n')
+            while not self._done.wait(self.interval):
+                try:
+                    tree = self._tree()
+                    cpu, rss, io = self._totals(tree)
+                except OSError as err:
+                    logging.warning(f'  telemetry: sampling failed: {err}')
+                    continue
+                now = time.time()
+
+                # cumulative counters drop when processes are orphaned
+                # or exit unreaped, so only count increases
+                used = max(0.0, cpu - last_cpu)
+                cores = used / (now - last_time)
+                last_cpu, last_time = cpu, now
+                for k in _io_keys:
+                    self.io[k] = max(self.io[k], io[k] - first_io[k])
+
+                self.num_samples += 1
+                self.elapsed = now - start
+                self.cpu_seconds += used
+                self.peak_cpu = max(self.peak_cpu, cores)
+                self.peak_rss = max(self.peak_rss, rss)
+                self.peak_procs = max(self.peak_procs, len(tree))
+
+                row = [f'{now - start:.1f}', str(len(tree)), f'{cores:.2f}', str(rss)] \
+                    + [str(self.io[k]) for k in _io_keys]
+                fid.write(','.join(row) + '\n')
+                fid.flush()
@@ -1,20 +1,560 @@
+import os, sys
+import time
+import json
+import fcntl
+import tempfile
+import threading
+import hashlib
+import configparser
 import subprocess
 import logging
+import ats_manager.names as names
 import ats_manager.utils as utils
+import ats_manager.modulefile as modulefile
+import ats_manager.proc as proc
+import ats_manager.telemetry as telemetry
+import ats_manager.registry as registry
+from ats_manager.config import config
 
 _make_test_cmd = \
 """#!/usr/bin/env bash
 source ${{MODULESHOME}}/init/profile
 
-echo "running make test"
-module load {}
+echo "running ctest"
+module load {modulefile}
 cd ${{AMANZI_BUILD_DIR}}
-make test
+ctest --output-on-failure -j{jobs} {ctest_args}
 """
 
-def amanziUnitTests(modulefile):
-    make_test_cmd = _make_test_cmd.format(modulefile)
+#
+# Test timings
+#
+# Durations of every test run are kept per module in
+# ATS_BASE/testing/timings, so that later runs can start the longest
+# tests first.  Without this, a few long tests started last dominate
+# the wall time of a parallel run.
+#
+def _timings_file(module_name):
+    return os.path.join(config['ATS_BASE'], 'testing', 'timings', names.clean(module_name)+'.json')
+
+
+def _update_store(filename, update):
+    """Reads a JSON store, updates it in place with update(store), and
+    writes it back.
+
+    Concurrent runs of the same module (shards, reruns, or variants)
+    share the store, so it is locked from the read through the write,
+    and written to a unique temporary file renamed into place.
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename+'.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(filename, 'r') as fid:
+                store = json.load(fid)
+        except (OSError, ValueError):
+            store = dict()
+        update(store)
+
+        fd, tmp = tempfile.mkstemp(prefix='.'+os.path.basename(filename)+'.',
+                                   dir=os.path.dirname(filename))
+        try:
+            with os.fdopen(fd, 'w') as fid:
+                json.dump(store, fid, indent=2, sort_keys=True)
+            os.replace(tmp, filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+
+def load_timings(module_name, kind):
+    """Dictionary of test --> duration, in seconds, of kind 'amanzi' or 'ats'."""
+    try:
+        with open(_timings_file(module_name), 'r') as fid:
+            return json.load(fid).get(kind, dict())
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_timings(module_name, kind, timings):
+    """Merges new test durations into the store."""
+    def update(store):
+        store.setdefault(kind, dict()).update(timings)
+    _update_store(_timings_file(module_name), update)
+
+
+#
+# Test result cache
+#
+# A passing test is recorded under a key hashing everything it depends
+# on: the installed ats binary and libraries (plus the test executable
+# for unit tests), the test's input files, and the module environment.
+# Later runs skip tests whose key is unchanged, so an update touching
+# only one PK reruns only the tests that could see the change.
+#
+_env_keys = ['LOADEDMODULES', 'PATH', 'LD_LIBRARY_PATH', 'PYTHONPATH']
+_env_prefixes = ['ATS_', 'AMANZI_', 'OMP_', 'OMPI_', 'MPICH_', 'I_MPI_']
+_file_hashes = dict()
+
+def _test_cache_file(module_name):
+    return os.path.join(config['ATS_BASE'], 'testing', 'results', names.clean(module_name)+'.json')
+
+
+def _hash_file(filename):
+    """sha256 of a file, remembered by path, size, and mtime."""
+    st = os.stat(filename)
+    memo = (filename, st.st_size, st.st_mtime_ns)
+    if memo not in _file_hashes:
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as fid:
+            for chunk in iter(lambda: fid.read(2**20), b''):
+                sha.update(chunk)
+        _file_hashes[memo] = sha.hexdigest()
+    return _file_hashes[memo]
+
+
+def _hash_files(filenames):
+    """Combined hash of those of filenames that exist."""
+    sha = hashlib.sha256()
+    for filename in sorted(filenames):
+        if os.path.isfile(filename):
+            sha.update(f'{filename} {_hash_file(filename)}\n'.encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _files_under(path):
+    if os.path.isfile(path):
+        return [path,]
+    files = []
+    for root, dirs, fnames in os.walk(path):
+        files.extend(os.path.join(root, f) for f in fnames)
+    return files
+
+
+def install_hash(env):
+    """Hash of the installed ats binary and libraries."""
+    amanzi_dir = env['AMANZI_DIR']
+    return _hash_files(_files_under(os.path.join(amanzi_dir, 'bin', 'ats'))
+                       + _files_under(os.path.join(amanzi_dir, 'lib')))
+
+
+def environment_hash(env):
+    """Hash of the parts of the environment that can change test results."""
+    items = sorted((k, v) for k, v in env.items()
+                   if k in _env_keys or any(k.startswith(p) for p in _env_prefixes))
+    return hashlib.sha256(json.dumps(items).encode('utf-8')).hexdigest()
+
+
+def test_key(*parts):
+    return hashlib.sha256(':'.join(parts).encode('utf-8')).hexdigest()
+
+
+def load_test_cache(module_name, kind):
+    """Dictionary of test --> key of its last passing run."""
+    try:
+        with open(_test_cache_file(module_name), 'r') as fid:
+            return json.load(fid).get(kind, dict())
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_test_cache(module_name, kind, passed, failed):
+    """Records keys of passing tests, and forgets failing ones."""
+    def update(store):
+        cached = store.setdefault(kind, dict())
+        cached.update(passed)
+        for test in failed:
+            cached.pop(test, None)
+    _update_store(_test_cache_file(module_name), update)
+
+
+#
+# Amanzi unit tests
+#
+# ctest schedules tests by the costs in Testing/Temporary/CTestCostData.txt
+# of the build dir, starting the most expensive first.  That file is
+# lost whenever the build is re-bootstrapped, so costs are seeded from
+# the timings store before running, and saved back to it after.
+#
+def _ctest_cost_file(build_dir):
+    return os.path.join(build_dir, 'Testing', 'Temporary', 'CTestCostData.txt')
+
+
+def _read_ctest_costs(filename):
+    """Dictionary of test --> (number of runs, average cost)."""
+    costs = dict()
+    try:
+        with open(filename, 'r') as fid:
+            for line in fid:
+                line = line.split()
+                if len(line) == 1 and line[0] == '---':
+                    break
+                if len(line) == 3:
+                    costs[line[0]] = (int(line[1]), float(line[2]))
+    except (OSError, ValueError):
+        pass
+    return costs
+
+
+def _seed_ctest_costs(build_dir, timings):
+    filename = _ctest_cost_file(build_dir)
+    costs = _read_ctest_costs(filename)
+    missing = [test for test in timings if test not in costs]
+    if len(missing) == 0:
+        return
+    for test in missing:
+        costs[test] = (1, timings[test])
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as fid:
+        for test, (count, cost) in sorted(costs.items()):
+            fid.write(f'{test} {count} {cost}\n')
+        fid.write('---\n')
+
+
+def _read_ctest_failed(filename):
+    """Tests listed as failed in the last run in CTestCostData.txt."""
+    failed = []
+    try:
+        with open(filename, 'r') as fid:
+            lines = fid.read().split('\n')
+    except OSError:
+        return failed
+    if '---' in lines:
+        failed = [l.strip() for l in lines[lines.index('---')+1:] if l.strip() != '']
+    return failed
+
+
+def list_ctest_tests(build_dir, env):
+    """List of (number, name, key inputs) of the ctest tests in build_dir."""
+    result = subprocess.run(['ctest', '--show-only=json-v1'], cwd=build_dir, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    tests = []
+    for i, test in enumerate(json.loads(result.stdout.decode('utf-8'))['tests']):
+        command = test.get('command', [])
+        files = [c for c in command if os.path.isfile(c)]
+        tests.append((i+1, test['name'], ' '.join(command) + ':' + _hash_files(files)))
+    return tests
+
+
+def amanziUnitTests(modulefile_name, jobs=None, use_cache=True, telemetry_interval=None):
+    """Runs the Amanzi unit tests with ctest, in parallel.
+
+    ctest works regardless of the generator used, and respects the
+    PROCESSORS property of MPI tests when packing them into jobs.
+    If use_cache, tests that passed before with the same key are
+    skipped.
+    """
+    if jobs is None:
+        jobs = utils.available_cores()
+
+    registry.touch(modulefile_name)
+    build_dir = modulefile.read_modulefile(modulefile_name)['AMANZI_BUILD_DIR']
+    _seed_ctest_costs(build_dir, load_timings(modulefile_name, 'amanzi'))
+
+    ctest_args = ''
+    keys = None
+    if use_cache:
+        try:
+            env = utils.module_environment(modulefile_name)
+            common = test_key(install_hash(env), environment_hash(env))
+            keys = dict((name, (number, test_key(common, inputs)))
+                        for number, name, inputs in list_ctest_tests(build_dir, env))
+        except (RuntimeError, OSError, ValueError, KeyError, subprocess.CalledProcessError) as err:
+            logging.warning(f'  cannot key unit tests, not using the test cache: {err}')
+
+    if keys is not None:
+        cached = load_test_cache(modulefile_name, 'amanzi')
+        to_run = [number for name, (number, key) in keys.items() if cached.get(name, None) != key]
+        logging.info(f"  skipping {len(keys) - len(to_run)} of {len(keys)} unit tests with cached passing results")
+        if len(to_run) == 0:
+            return 0
+        ctest_args = '-I 0,0,0,' + ','.join(str(n) for n in sorted(to_run))
+
+    make_test_cmd = _make_test_cmd.format(modulefile=modulefile_name, jobs=jobs,
+                                          ctest_args=ctest_args)
     logging.debug(make_test_cmd)
     logging.info("Running Amanzi unit tests")
     logging.info(make_test_cmd)
-    return utils.run_cmd('make_test', modulefile, make_test_cmd)
+    rc = utils.run_cmd('make_test', modulefile_name, make_test_cmd,
+                       telemetry_interval=telemetry_interval)
+
+    cost_file = _ctest_cost_file(build_dir)
+    costs = _read_ctest_costs(cost_file)
+    save_timings(modulefile_name, 'amanzi', dict((test, cost) for test, (_, cost) in costs.items()))
+    if keys is not None:
+        failed = _read_ctest_failed(cost_file)
+        if rc != 0 and len(failed) == 0:
+            failed = list(keys) # cannot tell which failed
+        save_test_cache(modulefile_name, 'amanzi',
+                        dict((name, key) for name, (number, key) in keys.items()
+                             if number in to_run and name not in failed),
+                        failed)
+    return rc
+
+
+#
+# ATS regression tests
+#
+# Tests are found in the *.cfg files of the regression test suite
+# (ATS_TESTS_DIR), each section of which is a test, with "np" giving
+# its number of MPI ranks.  Each test is run on its own through the
+# suite's regression_tests.py, and tests are packed so that the sum of
+# the ranks of running tests stays within the core budget.  Tests are
+# started longest first, by their durations in previous runs.
+#
+_non_test_sections = ['suites', 'default-test-criteria']
+
+def find_ats_tests(tests_dir):
+    """List of tests, each a dict with name, cfg file, and np."""
+    tests = []
+    for root, dirs, files in os.walk(tests_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.')
+                         and not d.endswith('.regression') and not d.endswith('.regression.gold'))
+        for f in sorted(files):
+            if not f.endswith('.cfg') or f == 'regression_tests.cfg':
+                continue
+            cfg_file = os.path.join(root, f)
+            cfg = configparser.ConfigParser(strict=False, interpolation=None)
+            try:
+                cfg.read(cfg_file)
+            except configparser.Error as err:
+                logging.warning(f'Skipping unreadable test config {cfg_file}: {err}')
+                continue
+            for section in cfg.sections():
+                if section.lower() in _non_test_sections:
+                    continue
+                np = int(cfg[section].get('np', '1'))
+                tests.append(dict(name=section, cfg=cfg_file, np=np,
+                                  id=os.path.relpath(cfg_file, tests_dir)+':'+section))
+    return tests
+
+
+def parse_shard(shard):
+    """Parses a shard I/N, with 1 <= I <= N, into (I, N)."""
+    try:
+        i, n = [int(v) for v in shard.split('/')]
+    except ValueError:
+        raise ValueError(f'Invalid shard "{shard}", expected I/N')
+    if not (1 <= i <= n):
+        raise ValueError(f'Invalid shard "{shard}", expected 1 <= I <= N')
+    return i, n
+
+
+def select_shard(tests, shard):
+    """Tests in shard I of N, assigned round-robin by sorted id."""
+    if shard is None:
+        return tests
+    i, n = parse_shard(shard)
+    tests = sorted(tests, key=lambda t : t['id'])
+    return tests[i-1::n]
+
+
+def order_by_duration(tests, timings):
+    """Sorts tests longest first.
+
+    Tests with no recorded duration are new or renamed, and are
+    started first as they may well be long.
+    """
+    longest = max(timings.values(), default=0.0)
+    return sorted(tests, key=lambda t : (-timings.get(t['id'], longest + 1), t['id']))
+
+
+def _ats_test_inputs(test, tests):
+    """Files a regression test depends on.
+
+    These are its own input file and gold results, plus any shared
+    files in its directory that do not belong to another test.
+    """
+    test_dir = os.path.dirname(test['cfg'])
+    others = set(t['name'] for t in tests if os.path.dirname(t['cfg']) == test_dir
+                 and t['name'] != test['name'])
+    files = []
+    for root, dirs, fnames in os.walk(test_dir):
+        if root == test_dir:
+            dirs[:] = [d for d in dirs if not d.endswith('.regression')
+                       and d.split('.')[0] not in others]
+            fnames = [f for f in fnames if f.split('.')[0] not in others]
+        files.extend(os.path.join(root, f) for f in fnames)
+    return files
+
+
+def _ats_test_keys(tests, all_tests, env):
+    """Dictionary of test id --> cache key, for each of tests."""
+    common = test_key(install_hash(env), environment_hash(env))
+    keys = dict()
+    for test in tests:
+        cfg = configparser.ConfigParser(strict=False, interpolation=None)
+        cfg.read(test['cfg'])
+        section = json.dumps(sorted(cfg[test['name']].items()))
+        keys[test['id']] = test_key(common, section, _hash_files(_ats_test_inputs(test, all_tests)))
+    return keys
+
+
+def _results_file(module_name):
+    return os.path.join(config['ATS_BASE'], 'testing', names.clean(module_name), 'results.json')
+
+
+def _ats_test_cmd(test, env, mpiexec):
+    return [sys.executable,
+            os.path.join(env['ATS_TESTS_DIR'], 'regression_tests.py'),
+            '--executable', os.path.join(env['AMANZI_DIR'], 'bin', 'ats'),
+            '--mpiexec', mpiexec,
+            '--config-files', test['cfg'],
+            '--tests', test['name']]
+
+
+class _ProcessSet:
+    """Pids of running test processes, safe to read from another thread."""
+    def __init__(self):
+        self._pids = set()
+        self._lock = threading.Lock()
+
+    def add(self, pid):
+        with self._lock:
+            self._pids.add(pid)
+
+    def discard(self, pid):
+        with self._lock:
+            self._pids.discard(pid)
+
+    def __call__(self):
+        with self._lock:
+            return list(self._pids)
+
+
+def _run_packed(tests, budget, env, mpiexec, log_dir, pids=None):
+    """Runs tests concurrently, keeping the sum of their np within budget.
+
+    Pending tests are started in order whenever they fit; a test
+    needing more than the whole budget is run alone.  pids, a
+    _ProcessSet, tracks the test processes while they run.
+
+    Returns
+    -------
+    dict : test id --> dict(passed, duration, log)
+    """
+    pending = list(tests)
+    running = dict()
+    results = dict()
+    free = budget
+
+    while len(pending) > 0 or len(running) > 0:
+        # start everything that fits
+        i = 0
+        while i < len(pending):
+            test = pending[i]
+            np = min(test['np'], budget)
+            if np <= free:
+                pending.pop(i)
+                log = os.path.join(log_dir, names.clean(test['id'])+'.log')
+                fid = open(log, 'w')
+                process = subprocess.Popen(_ats_test_cmd(test, env, mpiexec), env=env,
+                                           cwd=log_dir, stdout=fid, stderr=subprocess.STDOUT)
+                running[process] = (test, np, fid, log, time.time())
+                if pids is not None:
+                    pids.add(process.pid)
+                free -= np
+            else:
+                i += 1
+
+        # wait for something to finish
+        time.sleep(0.2)
+        for process in [p for p in running if p.poll() is not None]:
+            test, np, fid, log, start = running.pop(process)
+            if pids is not None:
+                pids.discard(process.pid)
+            fid.close()
+            free += np
+            passed = process.returncode == 0
+            results[test['id']] = dict(passed=passed, duration=time.time() - start, log=log)
+            logging.info('  {} {} ({:.1f} s)'.format('PASS' if passed else 'FAIL', test['id'],
+                                                    results[test['id']]['duration']))
+    return results
+
+
+def atsRegressionTests(module_name, jobs=None, shard=None, retries=0,
+                       rerun_failed=False, mpiexec='mpiexec', use_cache=True,
+                       telemetry_interval=None):
+    """Runs the ATS regression tests of an installation in parallel.
+
+    Tests are packed into a budget of jobs cores by their MPI rank
+    count.  shard, I/N, runs only the I-th of N equal parts of the
+    suite.  Failed tests are re-run up to retries times, and
+    rerun_failed runs only the tests that failed in the last run.  If
+    use_cache, tests that passed before with the same key are skipped.
+    If telemetry_interval (seconds) is provided, the resource use of
+    the tests is sampled into ATS_BASE/logs.
+
+    Returns
+    -------
+    int : number of failing tests
+    """
+    if jobs is None:
+        jobs = utils.available_cores()
+
+    registry.touch(module_name)
+    env = utils.module_environment(module_name)
+    tests_dir = env['ATS_TESTS_DIR']
+    logging.info("Running ATS regression tests")
+    logging.info(f"  tests dir: {tests_dir}")
+    all_tests = find_ats_tests(tests_dir)
+    tests = select_shard(all_tests, shard)
+
+    results_file = _results_file(module_name)
+    if rerun_failed:
+        try:
+            with open(results_file, 'r') as fid:
+                last = json.load(fid)
+        except (OSError, ValueError) as err:
+            logging.warning(f"  no results of a previous run to rerun failed tests from ({err}), "
+                            "running all tests")
+        else:
+            tests = [t for t in tests if t['id'] in last and not last[t['id']]['passed']]
+    keys = None
+    if use_cache:
+        keys = _ats_test_keys(tests, all_tests, env)
+        cached = load_test_cache(module_name, 'ats')
+        num_tests = len(tests)
+        tests = [t for t in tests if cached.get(t['id'], None) != keys[t['id']]]
+        logging.info(f"  skipping {num_tests - len(tests)} of {num_tests} tests with cached passing results")
+
+    tests = order_by_duration(tests, load_timings(module_name, 'ats'))
+    logging.info(f"  running {len(tests)} tests on {jobs} cores")
+
+    log_dir = os.path.join(os.path.dirname(results_file), 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+
+    # only the test processes are sampled, not all children of this
+    # process, which may include concurrent builds of other variants
+    pids = _ProcessSet()
+    sampler = None
+    if telemetry_interval is not None and proc.is_supported():
+        sampler = telemetry.Telemetry(pids, utils.telemetry_path('ats_tests', module_name),
+                                      telemetry_interval)
+        sampler.start()
+
+    try:
+        results = _run_packed(tests, jobs, env, mpiexec, log_dir, pids)
+        for attempt in range(retries):
+            failed = [t for t in tests if not results[t['id']]['passed']]
+            if len(failed) == 0:
+                break
+            logging.info(f"  retrying {len(failed)} failed tests (attempt {attempt+1} of {retries})")
+            results.update(_run_packed(failed, jobs, env, mpiexec, log_dir, pids))
+    finally:
+        if sampler is not None:
+            sampler.stop()
+
+    with open(results_file, 'w') as fid:
+        json.dump(results, fid, indent=2)
+    save_timings(module_name, 'ats', dict((tid, r['duration']) for tid, r in results.items()))
+    if keys is not None:
+        save_test_cache(module_name, 'ats',
+                        dict((tid, keys[tid]) for tid, r in results.items() if r['passed']),
+                        [tid for tid, r in results.items() if not r['passed']])
+
+    failed = sorted(tid for tid, r in results.items() if not r['passed'])
+    logging.info(f"  {len(results) - len(failed)} of {len(results)} tests passed")
+    for tid in failed:
+        logging.info(f"  FAILED: {tid} (see {results[tid]['log']})")
+    return len(failed)
@@ -0,0 +1,196 @@
+"""Timing of builds, by stage, TPL, and CMake target.
+
+Durations are appended as JSON lines to ATS_BASE/timing/timings.jsonl.
+Each record is one of:
+
+  stage  : a step of an install or update (clone, tpls, bootstrap, ...)
+  tpl    : a TPL built by the Amanzi superbuild, with its ExternalProject
+           steps (download, configure, build, install, ...)
+  target : a CMake target of the Amanzi/ATS build itself
+
+TPL and target times come from parsing the build output as it streams
+(see OutputTimer), so they are times between lines of output and are
+only as accurate as the output is frequent.  Records of one run of
+ats_manager share a run id, so builds can be compared run to run with
+bin/timing_report.py.
+"""
+import os
+import re
+import time
+import json
+import threading
+import contextlib
+import logging
+
+from ats_manager.config import config
+
+run_id = time.strftime('%Y%m%d-%H%M%S') + f'-{os.getpid()}'
+_lock = threading.Lock()
+
+_step_re = re.compile(rb"Performing (\w+) step .*for '([^']+)'")
+_completed_re = re.compile(rb"Completed '([^']+)'")
+_target_re = re.compile(rb"CMakeFiles/([^/\s]+)\.dir/")
+_built_re = re.compile(rb"Built target (\S+)")
+
+
+def timings_file():
+    return os.path.join(config['ATS_BASE'], 'timing', 'timings.jsonl')
+
+
+def record(name, kind, item, start, duration, **kwargs):
+    """Appends a timing record."""
+    rec = dict(run=run_id, name=name, kind=kind, item=item,
+               start=start, duration=duration)
+    rec.update(kwargs)
+    filename = timings_file()
+    with _lock:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'a') as fid:
+            fid.write(json.dumps(rec, sort_keys=True) + '\n')
+
+
+@contextlib.contextmanager
+def stage(name, item):
+    """Times the enclosed block as a stage of build name."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        logging.info(f'  {item} took {duration:.0f} s')
+        record(name, 'stage', item, start, duration)
+
+
+class OutputTimer:
+    """Times TPLs and targets from build output, fed as it streams."""
+    def __init__(self, name):
+        self.name = name
+        self.tpls = dict()    # tpl --> dict(start, end, steps, step, step_start, completed)
+        self.targets = dict() # target --> [start, end, completed]
+
+    def feed(self, lines):
+        now = time.time()
+        for line in lines:
+            match = _step_re.search(line)
+            if match is not None:
+                step, tpl = [m.decode('utf-8') for m in match.groups()]
+                info = self.tpls.setdefault(tpl, dict(start=now, steps=dict(), step=None,
+                                                      step_start=now, completed=False))
+                self._end_step(info, now)
+                info['step'] = step
+                info['step_start'] = now
+                continue
+
+            match = _completed_re.search(line)
+            if match is not None:
+                info = self.tpls.get(match.group(1).decode('utf-8'), None)
+                if info is not None:
+                    self._end_step(info, now)
+                    info['completed'] = True
+                continue
+
+            match = _built_re.search(line)
+            if match is not None:
+                target = self.targets.setdefault(match.group(1).decode('utf-8'), [now, now, False])
+                target[1] = now
+                target[2] = True
+                continue
+
+            match = _target_re.search(line)
+            if match is not None:
+                target = self.targets.setdefault(match.group(1).decode('utf-8'), [now, now, False])
+                target[1] = now
+
+    def _end_step(self, info, now):
+        if info['step'] is not None:
+            info['steps'][info['step']] = now - info['step_start']
+            info['step'] = None
+        info['end'] = now
+
+    def save(self):
+        """Records everything seen so far."""
+        now = time.time()
+        for tpl, info in self.tpls.items():
+            if not info['completed']:
+                self._end_step(info, now)
+            record(self.name, 'tpl', tpl, info['start'], info['end'] - info['start'],
+                   steps=info['steps'], completed=info['completed'])
+        for target, (start, end, completed) in self.targets.items():
+            record(self.name, 'target', target, start, end - start, completed=completed)
+
+
+def load(filename=None):
+    """List of all timing records, empty if none were recorded."""
+    if filename is None:
+        filename = timings_file()
+    records = []
+    if not os.path.isfile(filename):
+        return records
+    with open(filename, 'r') as fid:
+        for line in fid:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+def runs(records, name):
+    """Run ids of build name, oldest first."""
+    return sorted(set(r['run'] for r in records if r['name'] == name))
+
+
+def durations(records, name, run, kinds):
+    """Dictionary of (kind, item) --> duration for one run of a build."""
+    return dict(((r['kind'], r['item']), r['duration']) for r in records
+                if r['name'] == name and r['run'] == run and r['kind'] in kinds)
+
+
+def report(name, other=None, kinds=('stage', 'tpl'), top=None, threshold=1.5):
+    """Compares the timings of two builds, or the last two runs of one.
+
+    Returns the lines of a table, with items that took more than
+    threshold times as long flagged.
+    """
+    records = load()
+    if len(records) == 0:
+        raise ValueError(f'No timings recorded, in {timings_file()}')
+    name_runs = runs(records, name)
+    if len(name_runs) == 0:
+        raise ValueError(f'No timings recorded for {name}')
+
+    if other is None:
+        if len(name_runs) < 2:
+            raise ValueError(f'Only one run recorded for {name}, nothing to compare')
+        a = (name, name_runs[-2])
+        b = (name, name_runs[-1])
+    else:
+        other_runs = runs(records, other)
+        if len(other_runs) == 0:
+            raise ValueError(f'No timings recorded for {other}')
+        a = (name, name_runs[-1])
+        b = (other, other_runs[-1])
+
+    da = durations(records, a[0], a[1], kinds)
+    db = durations(records, b[0], b[1], kinds)
+    items = sorted(set(da) | set(db), key=lambda k : (kinds.index(k[0]), -max(da.get(k, 0), db.get(k, 0))))
+    if top is not None:
+        items = [k for k in items if k[0] != 'target'] + [k for k in items if k[0] == 'target'][0:top]
+
+    def fmt(d):
+        return '' if d is None else f'{d:.0f}'
+
+    lines = [f'A: {a[0]} (run {a[1]})',
+             f'B: {b[0]} (run {b[1]})',
+             '',
+             '{:<8} {:<40} {:>10} {:>10} {:>7}'.format('kind', 'item', 'A [s]', 'B [s]', 'B/A')]
+    for k in items:
+        ta, tb = da.get(k, None), db.get(k, None)
+        ratio = ''
+        flag = ''
+        if ta is not None and tb is not None and ta > 0:
+            ratio = f'{tb / ta:.2f}'
+            if tb / ta > threshold:
+                flag = ' <--'
+        lines.append('{:<8} {:<40} {:>10} {:>10} {:>7}{}'.format(k[0], k[1], fmt(ta), fmt(tb), ratio, flag))
+    return lines
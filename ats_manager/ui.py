@@ -21,12 +21,24 @@ def get_install_args(parser, amanzi=False, ats=False):
         if ats:
             groups['control'].add_argument('--skip-ats-tests', action='store_true',
                                            help='Skip running ATS tests.')
+        groups['control'].add_argument('--no-test-cache', action='store_true',
+                                       help='Run all tests, even those that passed before with an unchanged binary, inputs, and environment.')
 
     skip_clobber = groups['control'].add_mutually_exclusive_group()
     skip_clobber.add_argument('--skip-clone', action='store_true',
                         help='Skip cloning (and use existing repos)')
     skip_clobber.add_argument('--clobber', action='store_true',
                         help='Clobber any existing repos.')
+    skip_clobber.add_argument('--update-repo', action='store_true',
+                        help='Fetch and hard-reset an existing repo (and submodules) to the requested branches, removing local changes, instead of cloning.  Falls back to a fresh clone if the repo is broken.')
+    groups['control'].add_argument('--git-mirror', action='store_true',
+                                   help='Clone using shared mirrors of the repositories in ATS_BASE/mirrors as a reference, so new clones are fast and use little disk.')
+    groups['control'].add_argument('--clone-jobs', type=int, default=4,
+                                   help='Number of submodules to clone concurrently.')
+    groups['control'].add_argument('--clone-depth', type=int, default=None,
+                                   help='Make shallow clones of the repo and submodules with history truncated to this many commits.  The full history is fetched if a new branch is created.')
+    groups['control'].add_argument('--clone-filter', type=str, default=None,
+                                   help='Make partial clones of the repo and submodules using this filter, e.g. "blob:none" to fetch file contents only as they are checked out.')
     groups['control'].add_argument('--machine', default=None,
                                    help='Machine name to include in modulefile name')
     groups['control'].add_argument('--compiler-id', type=str, default=None,
@@ -36,6 +48,20 @@ def get_install_args(parser, amanzi=False, ats=False):
                                    help="Type of wrappers used to find the wrapper executables.  Valid include:\n  mpi = mpicc, mpicxx, mpifort\n  intel = mpiicc, mpiicpc, mpiiftn\n  vendor = cc, CC, ftn")
     groups['control'].add_argument('--mpi-dir', type=str, default=None,
                                    help="Location of the MPI installation")
+    groups['control'].add_argument('-j', '--jobs', type=int, default=None,
+                                   help="Number of parallel build jobs.  Defaults to the number of available cores, respecting CPU affinity and cgroup limits.")
+    groups['control'].add_argument('--memory-limit', type=float, default=None,
+                                   help="Memory limit, in GB, for the build.  Compile and link jobs are paused while the build's processes exceed it.  Defaults to 90%% of the available memory.")
+    groups['control'].add_argument('--mem-per-job', type=float, default=2.0,
+                                   help="Expected peak memory, in GB, of a single compile or link job.  When --jobs is not given, the number of jobs is capped at MEMORY_LIMIT / MEM_PER_JOB.  Set to 0 to disable.")
+    groups['control'].add_argument('--disable-memory-governor', action='store_true',
+                                   help="Do not monitor or throttle the build's memory use.")
+    groups['control'].add_argument('--fail-fast', action='store_true',
+                                   help="Kill the build as soon as a fatal CMake, compiler, or linker error appears in its output, rather than letting parallel make run on.")
+    groups['control'].add_argument('--telemetry', type=float, default=None, metavar='SECONDS',
+                                   help="Sample CPU, memory, I/O, and process count of builds and tests every TELEMETRY seconds, into a CSV file next to their logs in ATS_BASE/logs.")
+    groups['control'].add_argument('--evict', action='store_true',
+                                   help="Before building, remove least recently used build trees until disk use, plus that expected of this build, is within ATS_DISK_BUDGET.  Always done if ATS_DISK_AUTO_EVICT is set.")
     
     # branches
     if amanzi:
@@ -54,6 +80,14 @@ def get_install_args(parser, amanzi=False, ats=False):
             groups['branches'].add_argument('--new-ats-branch', type=str, default=None,
                                 help='Create a new branch of ATS, starting from ATS_BRANCH.')
 
+    # build matrix
+    if amanzi:
+        groups['matrix'] = parser.add_argument_group('matrix', 'build several variants of the same repository concurrently')
+        groups['matrix'].add_argument('--variant', type=str, action='append', default=list(),
+                                      help='Build variant, BUILD_TYPE[:COMPILER_ID[:MACHINE]], can appear multiple times.  Empty fields default to --build-type, --compiler-id, and --machine.  COMPILER_ID and MACHINE only label the build: all variants use the same compilers, MPI, and modulefiles, so must differ in BUILD_TYPE.  If provided, all variants share one clone and are built concurrently.')
+        groups['matrix'].add_argument('--core-budget', type=int, default=None,
+                                      help='Total number of cores split across all variants.  Defaults to all available cores.')
+
     # tpl control
     groups['tpls'] = parser.add_argument_group('TPLs', 'third party library controls')
     groups['tpls'].add_argument('--modulefile', type=str, action='append', default=list(),
@@ -62,6 +96,8 @@ def get_install_args(parser, amanzi=False, ats=False):
                         help='Build with geochemistry physics package')
     groups['tpls'].add_argument('--force-tpls', action='store_true',
                                 help='Force re-bootstrapping of existing TPLs')
+    groups['tpls'].add_argument('--artifact-cache', action='store_true',
+                                help='Restore TPL and Amanzi/ATS installs from packed archives in ATS_CACHE_DIR when one with the same configuration fingerprint exists, and pack new installs into it.')
     if not ats:
         groups['tpls'].add_argument('--enable-structured', action='store_true',
                             help='Build with geochemistry physics package')
@@ -85,6 +121,12 @@ def get_install_args(parser, amanzi=False, ats=False):
 
     groups['build_type'].add_argument('--bootstrap-options', type=str, default='',
                                       help='Additional options passed to bootstrap')
+    groups['build_type'].add_argument('--generator', type=str, default='make', choices=['make', 'ninja'],
+                                      help='Build system CMake generates for the TPLs and Amanzi/ATS.  Ninja gives much faster no-op and incremental rebuilds.')
+    groups['build_type'].add_argument('--compiler-cache', type=str, default=None, choices=['ccache', 'sccache'],
+                                      help='Compile through ccache or sccache, with a cache shared by all builds in ATS_BUILD_BASE/compiler-cache.')
+    groups['build_type'].add_argument('--compiler-cache-size', type=str, default='20G',
+                                      help='Maximum size of the compiler cache, e.g. 20G.')
     return parser, groups
 
 
@@ -93,14 +135,123 @@ def get_update_args(parser, ats=False):
                         help='Name of the modulefile (e.g. ats/master/debug)')
     parser.add_argument('--skip-recompile', action='store_true',
                         help='Skip re-compiling.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of parallel build jobs.  Defaults to the number of available cores.')
+    parser.add_argument('--fail-fast', action='store_true',
+                        help="Kill the build as soon as a fatal CMake, compiler, or linker error appears in its output.")
+    parser.add_argument('--telemetry', type=float, default=None, metavar='SECONDS',
+                        help="Sample CPU, memory, I/O, and process count of builds and tests every TELEMETRY seconds, into a CSV file next to their logs in ATS_BASE/logs.")
     parser.add_argument('--skip-amanzi-tests', action='store_true',
                         help='Skip running Amanzi tests.')
     if ats:
         parser.add_argument('--skip-ats-tests', action='store_true',
                             help='Skip running ATS tests.')
+    parser.add_argument('--no-test-cache', action='store_true',
+                        help='Run all tests, even those that passed before with an unchanged binary, inputs, and environment.')
     return
         
 
+def get_ats_test_args(parser):
+    parser.add_argument('modulefile', type=str,
+                        help='Name of the modulefile (e.g. ats/master/debug)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of cores to run tests on.  Tests are packed so that the sum of their MPI ranks stays within this.  Defaults to the number of available cores.')
+    parser.add_argument('--shard', type=str, default=None,
+                        help='Run only part I of N of the tests, given as I/N, e.g. to split the suite across CI jobs.')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='Number of times to re-run failing tests.')
+    parser.add_argument('--rerun-failed', action='store_true',
+                        help='Run only the tests that failed in the last run.')
+    parser.add_argument('--mpiexec', type=str, default='mpiexec',
+                        help='MPI launcher used by the tests.')
+    parser.add_argument('--telemetry', type=float, default=None, metavar='SECONDS',
+                        help="Sample CPU, memory, I/O, and process count of the tests every TELEMETRY seconds, into a CSV file in ATS_BASE/logs.")
+    parser.add_argument('--no-test-cache', action='store_true',
+                        help='Run all tests, even those that passed before with an unchanged binary, inputs, and environment.')
+    return
+
+
+def get_timing_report_args(parser):
+    parser.add_argument('modulefile', type=str,
+                        help='Name of the modulefile (e.g. ats/master/debug)')
+    parser.add_argument('other', type=str, nargs='?', default=None,
+                        help='Name of a second modulefile to compare against.  If not given, the last two runs of MODULEFILE are compared.')
+    parser.add_argument('--targets', action='store_true',
+                        help='Also report CMake targets.')
+    parser.add_argument('--top', type=int, default=20,
+                        help='Number of (longest) targets to report.')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='Flag items that took more than this many times as long.')
+    return
+
+
+def get_registry_args(parser):
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = commands.add_parser('list', help='List registered builds.')
+    query_parser = commands.add_parser('query', help='List registered builds matching filters.')
+    for p in [list_parser, query_parser]:
+        p.add_argument('--all', action='store_true',
+                       help='Include removed builds.')
+        p.add_argument('--long', action='store_true',
+                       help='Show all fields.')
+        p.add_argument('--json', action='store_true',
+                       help='Print as JSON.')
+
+    query_parser.add_argument('--name', type=str, default=None,
+                              help='Glob pattern on the build name, e.g. "ats/master/*"')
+    query_parser.add_argument('--kind', type=str, default=None, choices=['ats', 'amanzi', 'amanzi-tpls'],
+                              help='Kind of build.')
+    query_parser.add_argument('--status', type=str, default=None,
+                              choices=['building', 'installed', 'failed', 'cleaned', 'removed'],
+                              help='Status of the build.')
+    query_parser.add_argument('--tpls', type=str, default=None,
+                              help='Glob pattern on the TPLs version used, e.g. "0.98.*"')
+    query_parser.add_argument('--tpls-name', type=str, default=None,
+                              help='Glob pattern on the name of the TPLs used.')
+    query_parser.add_argument('--amanzi-commit', type=str, default=None,
+                              help='Amanzi commit, or a prefix of it.')
+    query_parser.add_argument('--ats-commit', type=str, default=None,
+                              help='ATS commit, or a prefix of it.')
+    query_parser.add_argument('--where', type=str, default=None,
+                              help='Additional SQL condition on the builds table, e.g. "install_size > 5e9"')
+
+    commands.add_parser('rescan', help='Register existing builds that are not yet in the registry.')
+    return
+
+
+def get_evict_args(parser):
+    parser.add_argument('--budget', type=str, default=None,
+                        help='Total size of all build and install dirs to evict down to, e.g. 500G.  Defaults to ATS_DISK_BUDGET.')
+    parser.add_argument('--installs', action='store_true',
+                        help='Also remove whole builds (install, build dir, modulefile, and bootstrap script) that no remaining install depends on, if removing build trees is not enough.')
+    parser.add_argument('--keep', type=str, action='append', default=list(),
+                        help='Name of a build never to evict, can appear multiple times.')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Only report what would be evicted.')
+    parser.add_argument('--no-refresh', action='store_true',
+                        help='Trust the sizes recorded in the registry rather than measuring them anew.')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Removes files and directories without prompting.')
+    parser.add_argument('--wait', action='store_true',
+                        help='Wait until removed directories are deleted, rather than leaving that to a background process.')
+    return
+
+
+def get_gc_args(parser):
+    parser.add_argument('--min-age', type=float, default=24,
+                        help='Only remove orphans not modified in this many hours, as they may belong to an install in progress.')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Only report orphans and the space they use.')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Removes orphans without prompting.')
+    parser.add_argument('--wait', action='store_true',
+                        help='Wait until removed directories are deleted, rather than leaving that to a background process.')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Number of locations to scan concurrently.')
+    return
+
+
 def get_clean_args(parser):
     parser.add_argument('module_name', type=str,
                         help='Name of the modulefile (e.g. ats/master/debug)')
@@ -108,4 +259,6 @@ def get_clean_args(parser):
                         help='Additionally removes modulefile and bootstrap script.')
     parser.add_argument('-f', '--force', action='store_true',
                         help='Removes files and directories without prompting.')
+    parser.add_argument('--wait', action='store_true',
+                        help='Wait until removed directories are deleted, rather than leaving that to a background process.')
     return
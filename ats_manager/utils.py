@@ -1,71 +1,479 @@
 import os,stat,sys
+import time
+import grp
+import tempfile
+import concurrent.futures
+import signal
+import selectors
+import threading
 import subprocess
 import logging
 
 import ats_manager.names as names
+import ats_manager.proc as proc
+import ats_manager.governor as governor
+import ats_manager.errors as errors
+import ats_manager.telemetry as telemetry
 from ats_manager.config import config
 
+def _cgroup_cpu_limit():
+    """CPU limit imposed by the cgroup (v2 or v1), or None if unlimited."""
+    # cgroup v2
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as fid:
+            quota, period = fid.read().split()[0:2]
+        if quota != 'max':
+            return float(quota) / float(period)
+        return None
+    except (OSError, ValueError):
+        pass
+
+    # cgroup v1
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as fid:
+            quota = int(fid.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as fid:
+            period = int(fid.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cores():
+    """Number of CPUs this process may run on.
+
+    Accounts for the CPU affinity mask (e.g. taskset or a batch
+    scheduler's cpuset) and any cgroup CPU quota (e.g. containers).
+    """
+    try:
+        ncores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        ncores = os.cpu_count() or 1
+
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        ncores = min(ncores, max(1, int(limit)))
+    return ncores
+
+
 def script_name(prefix, name):
     return names.clean(prefix+'-'+name+'.sh')
 
 
-def run_cmd(prefix, name, cmd):
-    script = script_name(prefix, name)
-    outfile = os.path.join(os.environ['ATS_BASE'], 'scripts', script)
+def script_path(prefix, name):
+    return os.path.join(os.environ['ATS_BASE'], 'scripts', script_name(prefix, name))
+
+
+def write_executable(path, contents):
+    """Writes an executable script that other processes may be running.
+
+    The script is written to a temporary file next to it and renamed
+    into place, so it is never seen half-written, and left untouched if
+    unchanged.
+    """
+    try:
+        with open(path, 'r') as fid:
+            if fid.read() == contents:
+                return
+    except OSError:
+        pass
+    fd, tmp = tempfile.mkstemp(prefix='.'+os.path.basename(path)+'.', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as fid:
+            fid.write(contents)
+        os.chmod(tmp, 0o755)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def write_script(prefix, name, cmd):
+    outfile = script_path(prefix, name)
     with open(outfile,'w') as fid:
         fid.write(cmd)
     os.chmod(outfile, stat.S_IRWXU) # owner r/w/x
     chmod(outfile) # group, other according to config
-    return run_script(prefix, name)
 
 
-def run_script(prefix, name):
+def run_cmd(prefix, name, cmd, **kwargs):
+    write_script(prefix, name, cmd)
+    return run_script(prefix, name, **kwargs)
+
+
+def log_path(prefix, name):
+    return os.path.join(os.environ['ATS_BASE'], 'logs', names.clean(prefix+'-'+name+'.log'))
+
+
+def telemetry_path(prefix, name):
+    return os.path.join(os.environ['ATS_BASE'], 'logs', names.clean(prefix+'-'+name+'.telemetry.csv'))
+
+
+_echo_lock = threading.Lock()
+
+def _echo(stream, data):
+    with _echo_lock:
+        stream.write(data)
+        stream.flush()
+
+
+def _timestamped(lines, label, when):
+    """Prefixes each of a list of lines (bytes) with a time and stream label."""
+    stamp = (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))
+             + '.{:03d} {}| '.format(int(1000 * (when % 1)), label)).encode('utf-8')
+    return b''.join(stamp + line + b'\n' for line in lines)
+
+
+def stream_output(process, log, echo=True, on_lines=None):
+    """Multiplexes the stdout and stderr of process into log until both close.
+
+    Output is read in large chunks as it becomes available on either
+    pipe, so a very verbose process is never blocked on its output.
+    Complete lines are written to log with a timestamp and the stream
+    they came from, and (if echo) to our own stdout or stderr.  If
+    provided, on_lines is called with each list of complete lines.
+    """
+    sel = selectors.DefaultSelector()
+    streams = dict()
+    for pipe, label, out in [(process.stdout, 'out', sys.stdout),
+                             (process.stderr, 'err', sys.stderr)]:
+        if pipe is not None:
+            os.set_blocking(pipe.fileno(), False)
+            sel.register(pipe, selectors.EVENT_READ, label)
+            streams[label] = [b'', out]
+
+    while len(sel.get_map()) > 0:
+        for key, _ in sel.select():
+            label = key.data
+            try:
+                chunk = os.read(key.fd, 2**16)
+            except BlockingIOError:
+                continue
+
+            partial = streams[label][0]
+            if chunk:
+                data = partial + chunk
+                end = data.rfind(b'\n')
+                if end < 0:
+                    streams[label][0] = data
+                    continue
+                lines, streams[label][0] = data[:end].split(b'\n'), data[end+1:]
+            else:
+                # EOF, flush whatever is left
+                sel.unregister(key.fileobj)
+                key.fileobj.close()
+                if len(partial) == 0:
+                    continue
+                lines = [partial,]
+                streams[label][0] = b''
+
+            log.write(_timestamped(lines, label, time.time()))
+            if on_lines is not None:
+                on_lines(lines)
+            if echo:
+                _echo(streams[label][1], b'\n'.join(lines).decode('utf-8', 'replace') + '\n')
+    sel.close()
+    log.flush()
+
+
+def _kill_tree(process):
+    """Kills the process group of a process started in its own session."""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        os.killpg(process.pid, signal.SIGCONT) # in case the governor paused anything
+    except ProcessLookupError:
+        return
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        pass
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_script(prefix, name, memory_limit=None, echo=True, fail_fast=False, on_lines=None,
+               telemetry_interval=None):
+    """Runs a script from ATS_BASE/scripts, logging and echoing its output.
+
+    stdout and stderr are streamed, with timestamps, to a log in
+    ATS_BASE/logs.  This is safe to call from several threads at once,
+    e.g. to run builds concurrently.
+
+    The output is scanned for fatal errors, and a summary of the first
+    is logged if the script fails.  If fail_fast, the script and
+    everything it started are killed as soon as an error is seen.
+
+    If memory_limit (bytes) is provided, a MemoryGovernor throttles the
+    script's process tree to stay under that resident memory.  If
+    provided, on_lines is also called with each batch of output lines.
+    If telemetry_interval (seconds) is provided, the resource use of the
+    process tree is sampled into a CSV file next to the log.
+    """
     script = script_name(prefix, name)
-    outfile = os.path.join(os.environ['ATS_BASE'], 'scripts', script)
+    outfile = script_path(prefix, name)
+    logfile = log_path(prefix, name)
     logging.info('Running {}'.format(script))
     logging.info('  file  {}'.format(outfile))
+    logging.info('  log   {}'.format(logfile))
     assert(os.path.isfile(outfile))
-    process = subprocess.Popen([outfile,], shell=False, stdout=subprocess.PIPE)
-    while True:
-        output = process.stdout.readline()
-        if process.poll() is not None:
-            break
-        if output:
-            print(output.decode('utf-8').strip())
+    os.makedirs(os.path.dirname(logfile), exist_ok=True)
 
-    if process.stderr is not None:
-        logging.error(process.stderr.decode('utf-8'))
-    return process.returncode
+    scanner = errors.ErrorScanner()
+    killed = []
+    with open(logfile, 'wb') as log:
+        # a session of its own, so the whole build can be killed at once
+        process = subprocess.Popen([outfile,], shell=False, bufsize=0,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   start_new_session=fail_fast)
 
+        def scan(lines):
+            if on_lines is not None:
+                on_lines(lines)
+            if scanner.feed(lines) and fail_fast:
+                logging.error('{}: fatal error detected, killing the build'.format(script))
+                killed.append(threading.Thread(target=_kill_tree, args=(process,), daemon=True))
+                killed[0].start()
 
-def chmod(path, group=''):
-    logging.info(f'  running chgrp/chmod on {path}')
-    if group != '':
+        gov = None
+        if memory_limit is not None:
+            if proc.is_supported():
+                logging.info(f'  memory limit {memory_limit / 2**30:.1f} GB')
+                gov = governor.MemoryGovernor(process.pid, memory_limit)
+                gov.start()
+            else:
+                logging.warning('  memory governor requires /proc, running without it')
+
+        sampler = None
+        if telemetry_interval is not None:
+            if proc.is_supported():
+                sampler = telemetry.Telemetry(process.pid, telemetry_path(prefix, name),
+                                              telemetry_interval)
+                sampler.start()
+            else:
+                logging.warning('  telemetry requires /proc, running without it')
+
+        try:
+            stream_output(process, log, echo, scan)
+            rc = process.wait()
+        except KeyboardInterrupt:
+            if fail_fast:
+                _kill_tree(process)
+            raise
+        finally:
+            if gov is not None:
+                gov.stop()
+            if sampler is not None:
+                sampler.stop()
+            for thread in killed:
+                thread.join()
+
+    if rc != 0:
+        logging.error('{} failed with return code {}, see {}'.format(script, rc, logfile))
+        scanner.log_summary()
+    elif scanner.num_errors > 0:
+        logging.warning('{} succeeded, but its output had {} lines that look like errors'.format(
+            script, scanner.num_errors))
+    return rc
+
+
+_module_env_cmd = \
+"""if [ ! -z "${{MODULESHOME}}" ]; then
+    source ${{MODULESHOME}}/init/profile
+fi
+if [ ! -z "${{ATS_BASE}}" ]; then
+    module use -a ${{ATS_BASE}}/modulefiles
+fi
+module load {module_name} || exit 1
+env -0
+"""
+def module_environment(module_name):
+    """The environment, as a dict, after loading a modulefile."""
+    cmd = _module_env_cmd.format(module_name=module_name)
+    result = subprocess.run(['bash', '-c', cmd], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, check=False)
+    if result.returncode != 0:
+        raise RuntimeError('Failed to load module {}: {}'.format(module_name,
+                                                                 result.stderr.decode('utf-8')))
+    env = dict()
+    for entry in result.stdout.decode('utf-8').split('\0'):
+        if '=' in entry:
+            key, val = entry.split('=', 1)
+            env[key] = val
+    return env
+
+
+def _chmod_stamp(path):
+    # kept in the tree, so it goes with it when the tree is removed
+    return os.path.join(path, '.ats_manager_chmod')
+
+
+class _ChmodPass:
+    """One permission pass over a tree; see chmod()."""
+    def __init__(self, ex, non_ex, gid, since):
+        self.ex = ex
+        self.non_ex = non_ex
+        self.gid = gid
+        self.since = since
+        self.num_checked = 0
+        self.num_changed = 0
+        self._lock = threading.Lock()
+
+    def fix(self, path, st, is_dir):
+        """Sets the mode and group of one entry, if not already right."""
+        if is_dir or st.st_mode & stat.S_IXUSR: # is owner-executable?
+            mode = self.ex
+        else:
+            mode = self.non_ex
+        changed = False
+        if stat.S_IMODE(st.st_mode) != mode:
+            os.chmod(path, mode)
+            changed = True
+        if self.gid is not None and st.st_gid != self.gid:
+            os.chown(path, -1, self.gid)
+            changed = True
+        return changed
+
+    def scan(self, dirname):
+        """Fixes the entries of one directory, returning its subdirectories."""
+        # every entry is stat'ed, as a chmod or rewrite of an existing
+        # file changes its own ctime but not that of its directory; only
+        # entries not changed since the last pass are left alone.  ctime
+        # is used as, unlike mtime, it is not restored by tar or cp -p.
+        subdirs = []
+        checked = 0
+        changed = 0
+        with os.scandir(dirname) as it:
+            for entry in it:
+                if entry.is_symlink() or entry.name.startswith('.#'): # dead files, go away
+                    continue
+                is_dir = entry.is_dir(follow_symlinks=False)
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if is_dir:
+                    subdirs.append(entry.path)
+                if self.since is not None and st.st_ctime < self.since:
+                    continue
+                checked += 1
+                if self.fix(entry.path, st, is_dir):
+                    changed += 1
+        with self._lock:
+            self.num_checked += checked
+            self.num_changed += changed
+        return subdirs
+
+
+def chmod(path, group='', incremental=False, jobs=16):
+    """Normalizes the permissions (and group) of a file or a tree.
+
+    Directories and owner-executable files get 775 if there is an admin
+    group (from the argument, or else ATS_ADMIN_GROUP), and 755
+    otherwise.  Other files get 664 or 644.  Entries already right are
+    left alone, and symlinks are never followed.
+
+    Directories are scanned concurrently by jobs threads, as the time
+    is mostly spent waiting on metadata operations of the filesystem.
+    If incremental, the whole tree is still scanned, but only entries
+    created or changed since the last pass over path, as recorded in a
+    stamp file at its root, are touched.
+    """
+    start = time.time()
+    if group == '':
         group = config['ATS_ADMIN_GROUP']
-    
+
     if group != '':
         ex = 0o775
         non_ex = 0o664
+        gid = grp.getgrnam(group).gr_gid
     else:
         ex = 0o755
         non_ex = 0o644
+        gid = None
+
+    if not os.path.isdir(path):
+        if os.path.isfile(path):
+            _ChmodPass(ex, non_ex, gid, None).fix(path, os.stat(path), False)
+        return
+
+    stamp = _chmod_stamp(path)
+    since = None
+    if incremental:
+        try:
+            # a little slack for clock skew with a networked filesystem
+            since = os.path.getmtime(stamp) - 2
+        except OSError:
+            pass
+
+    pass_ = _ChmodPass(ex, non_ex, gid, since)
+    st = os.stat(path)
+    pass_.num_checked += 1
+    if pass_.fix(path, st, True):
+        pass_.num_changed += 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        level = [path,]
+        while len(level) > 0:
+            results = executor.map(pass_.scan, level)
+            level = [subdir for subdirs in results for subdir in subdirs]
+
+    with open(stamp, 'w') as fid:
+        fid.write(path)
+    os.utime(stamp, (start, start))
+    logging.info('  chmod {}: changed {} of {} entries checked in {:.1f} s{}'.format(
+        path, pass_.num_changed, pass_.num_checked, time.time() - start,
+        ' (incremental)' if since is not None else ''))
+
+
+def _scan_usage(dirname):
+    """Disk usage and count of the entries of one directory, and its subdirectories."""
+    usage = 0
+    count = 0
+    subdirs = []
+    try:
+        with os.scandir(dirname) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                usage += st.st_blocks * 512
+                count += 1
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        pass
+    return usage, count, subdirs
+
+
+def disk_usage(path, jobs=16):
+    """Disk usage, in bytes, and number of entries of a tree (like du).
+
+    Directories are scanned concurrently, as for chmod.
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return 0, 0
+    usage = st.st_blocks * 512
+    count = 1
+    if not stat.S_ISDIR(st.st_mode):
+        return usage, count
 
-    for root, dirs, files in os.walk(path):
-        for d in dirs:
-            dirname = os.path.join(root, d)
-            os.chmod(dirname, ex)
-            if group != '':
-                shutil.chown(dirname, group=group)
-
-        for f in files:
-            if not f.startswith('.#'): # dead files, go away
-                filename = os.path.join(root, f)
-                if os.stat(filename).st_mode & 0o00100: # is owner-executable?
-                    os.chmod(filename, ex)
-                else:
-                    os.chmod(filename, non_ex)
-                if group != '':
-                    shutil.chown(filename, group=group)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        level = [path,]
+        while len(level) > 0:
+            next_level = []
+            for u, c, subdirs in executor.map(_scan_usage, level):
+                usage += u
+                count += c
+                next_level.extend(subdirs)
+            level = next_level
+    return usage, count
 
 
 def query_yes_no(question, default="yes"):
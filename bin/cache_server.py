@@ -0,0 +1,20 @@
+import argparse
+import ats_manager.remote as remote
+from ats_manager.config import config
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Serve a directory as an ATS_CACHE_URL for packed installs.")
+    parser.add_argument('directory', type=str, nargs='?', default=config['ATS_CACHE_DIR'],
+                        help='Directory of archives to serve.  Defaults to ATS_CACHE_DIR.')
+    parser.add_argument('-p', '--port', type=int, default=8000,
+                        help='Port to listen on.')
+    parser.add_argument('--bind', type=str, default='127.0.0.1',
+                        help='Address to bind to, e.g. 0.0.0.0 for all interfaces.  Defaults to localhost only, as uploads are not authenticated: serve other machines only on a trusted network.')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    args = get_args()
+    remote.serve(args.directory, args.port, args.bind)
@@ -0,0 +1,19 @@
+import sys
+import argparse
+import ats_manager as manager
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Remove least recently used build trees, or whole builds, until disk use is within budget.")
+    manager.get_evict_args(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    args = get_args()
+    budget = None if args.budget is None else manager.quota.parse_size(args.budget)
+    rc, evicted = manager.evict(budget, installs=args.installs, keep=args.keep,
+                                dry_run=args.dry_run, force=args.force, wait=args.wait,
+                                refresh=(not args.no_refresh))
+    sys.exit(rc)
@@ -0,0 +1,16 @@
+import sys
+import argparse
+import ats_manager as manager
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Find and remove orphaned scripts, modulefiles, and build and install trees left by failed or aborted installs.")
+    manager.get_gc_args(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    args = get_args()
+    rc, removed = manager.gc(**vars(args))
+    sys.exit(rc)
@@ -17,6 +17,10 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     
     args = get_args()
-    rc, module = ats_manager.install_amanzi(args)
+    if len(args.variant) > 0:
+        args.repo_kind = 'amanzi'
+        rc, modules = ats_manager.install_matrix(args)
+    else:
+        rc, module = ats_manager.install_amanzi(args)
     sys.exit(rc)
     
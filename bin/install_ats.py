@@ -16,6 +16,10 @@ if __name__ == "__main__":
     import logging
     logging.basicConfig(level=logging.INFO)
     args = get_args()
-    rc, module = ats_manager.install_ats(args)
+    if len(args.variant) > 0:
+        args.repo_kind = 'ats'
+        rc, modules = ats_manager.install_matrix(args)
+    else:
+        rc, module = ats_manager.install_ats(args)
     sys.exit(rc)
     
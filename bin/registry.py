@@ -0,0 +1,38 @@
+import sys
+import json
+import argparse
+import ats_manager as manager
+
+_fields = ['name', 'status', 'amanzi_commit', 'ats_commit', 'tpls_name', 'install_size', 'build_size', 'last_used']
+
+def get_args():
+    parser = argparse.ArgumentParser(description="List and query the registry of installed builds.")
+    manager.get_registry_args(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    args = get_args()
+    if args.command == 'rescan':
+        added = manager.registry.rescan()
+        logging.info(f'Registered {len(added)} builds')
+        sys.exit(0)
+
+    filters = dict()
+    if args.command == 'query':
+        filters = dict(name=args.name, kind=args.kind, status=args.status,
+                       tpls_version=args.tpls, tpls_name=args.tpls_name,
+                       amanzi_commit=args.amanzi_commit, ats_commit=args.ats_commit)
+    where = args.where if args.command == 'query' else None
+    if not args.all and filters.get('status', None) is None:
+        where = "status != 'removed'" + ('' if where is None else f' AND ({where})')
+
+    rows = manager.registry.query(where=where, **filters)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        fields = manager.registry.columns if args.long else _fields
+        print('\n'.join(manager.registry.format_table(rows, fields)))
+    sys.exit(0)
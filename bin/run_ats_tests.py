@@ -0,0 +1,24 @@
+import sys
+import argparse
+import ats_manager as manager
+
+def get_args():
+    parser = argparse.ArgumentParser('Run the ATS regression tests of an installation.')
+    manager.get_ats_test_args(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    args = get_args()
+
+    rc = manager.test_runner.atsRegressionTests(args.modulefile,
+                                                jobs=args.jobs,
+                                                shard=args.shard,
+                                                retries=args.retries,
+                                                rerun_failed=args.rerun_failed,
+                                                mpiexec=args.mpiexec,
+                                                use_cache=(not args.no_test_cache),
+                                                telemetry_interval=args.telemetry)
+    sys.exit(min(rc, 255))
@@ -0,0 +1,23 @@
+import sys
+import argparse
+import ats_manager as manager
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Compare the build timings of two builds, or of the last two runs of one build.")
+    manager.get_timing_report_args(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    args = get_args()
+    kinds = ('stage', 'tpl', 'target') if args.targets else ('stage', 'tpl')
+    try:
+        lines = manager.timing.report(args.modulefile, args.other, kinds=kinds,
+                                      top=args.top, threshold=args.threshold)
+    except ValueError as err:
+        logging.error(str(err))
+        sys.exit(1)
+    print('\n'.join(lines))
+    sys.exit(0)
@@ -14,5 +14,10 @@ if __name__ == '__main__':
     args = get_args()
 
     rc, module = manager.update_amanzi(args.modulefile,
-                                        run_amanzi_tests=(not args.skip_amanzi_tests))
+                                        recompile=(not args.skip_recompile),
+                                        run_amanzi_tests=(not args.skip_amanzi_tests),
+                                        jobs=args.jobs,
+                                        use_test_cache=(not args.no_test_cache),
+                                        fail_fast=args.fail_fast,
+                                        telemetry_interval=args.telemetry)
     sys.exit(rc)
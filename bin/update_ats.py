@@ -16,5 +16,9 @@ if __name__ == '__main__':
     rc, module = manager.update_ats(args.modulefile,
                                     recompile=(not args.skip_recompile),
                                     run_amanzi_tests=(not args.skip_amanzi_tests),
-                                    run_ats_tests=(not args.skip_ats_tests))
+                                    run_ats_tests=(not args.skip_ats_tests),
+                                    jobs=args.jobs,
+                                    use_test_cache=(not args.no_test_cache),
+                                    fail_fast=args.fail_fast,
+                                    telemetry_interval=args.telemetry)
     sys.exit(rc)